@@ -1,50 +1,147 @@
+import time
+# wall clock at the start of the import, for the cold start report
+import_clock = time.perf_counter()
+
+import robot_config
 from robot_config import robots
+from fitness_cache import FitnessCache, genome_hash
+from frame_writer import FrameWriter
+from phase_profiler import PhaseProfiler
+from trajectory_writer import TrajectoryWriter
 import sys
 import taichi as ti
 import math
 import numpy as np
 import os
+import multiprocessing
+import multiprocessing.connection
 import random
 import numpy as np
-
-
+from typing import NamedTuple
+import contextlib
+import functools
+import json
+
+
+# Runtime settings, applied by init_taichi() once the command line has been
+# parsed. Importing this module does not start Taichi or open a window.
+arch = 'cpu'
+# Directory of Taichi's offline kernel cache (None: Taichi's default). The
+# cache is keyed on the kernel source after the module settings and field
+# sizes are baked in, so every robot size bucket and setting combination
+# has its own entries; `prewarm` fills it ahead of time.
+kernel_cache = None
+precision = 'f32'
 real = ti.f32
-ti.init(default_fp=real)
+# draw offscreen (frames can still be saved) for machines without a display
+headless = False
+# phase timings from process start, reported once the first step has run
+cold_start = None
+
+
+def init_taichi(**kwargs):
+    """Starts the Taichi runtime with the configured arch and precision."""
+    global real
+    real = {'f32': ti.f32, 'f64': ti.f64}[precision]
+    if kernel_cache:
+        kwargs.setdefault('offline_cache_file_path', kernel_cache)
+    ti.init(arch=getattr(ti, arch), default_fp=real, **kwargs)
+
+
+def report_cold_start():
+    global cold_start
+    ti.sync()
+    phases = dict(cold_start, first_step=time.perf_counter())
+    cold_start = None
+    durations = []
+    previous = import_clock
+    for name, clock in phases.items():
+        durations.append(f'{name} {clock - previous:.2f} s')
+        previous = clock
+    print(f'Cold start: {previous - import_clock:.2f} s to the first simulated '
+          f'step ({", ".join(durations)})')
 
 max_steps = 4096
 vis_interval = 256
 output_vis_interval = 16
+video_fps = 30
 steps = 2048
-assert steps * 2 <= max_steps
+
+# Forward-only rollouts (no gradients) keep just the current and previous
+# step of the state in a ring buffer, so memory no longer grows with the
+# horizon and rollouts may run past max_steps. Set before fields are
+# allocated.
+forward_only = False
+# number of time slots in the state fields, chosen by allocate_fields
+state_slots = max_steps
+# Optional strided recording of the state: every record_interval steps a
+# frame is copied into a buffer of record_capacity frames (wrapping around)
+record_interval = 0
+record_capacity = 1024
+# frames copied out of the recording buffer at a time by trajectory export
+trajectory_chunk = 256
+# Gradient checkpointing for optimize(): with K = checkpoint_interval > 0 the
+# state fields hold one segment of K + 1 steps, the state is saved every K
+# steps and each segment is recomputed during the backward pass.
+checkpoint_interval = 0
+# True when the state slots wrap around during a rollout (ring buffer or
+# checkpointing), set by allocate_fields
+reuse_slots = False
 
 vis_resolution = 1024
 
 scalar = lambda: ti.field(dtype=real)
 vec = lambda: ti.Vector.field(2, dtype=real)
 
-loss = scalar()
-
 use_toi = False
-
-x = vec()
-v = vec()
-rotation = scalar()
-# angular velocity
-omega = scalar()
-
-halfsize = vec()
-
-inverse_mass = scalar()
-inverse_inertia = scalar()
-
-v_inc = vec()
-x_inc = vec()
-
-rotation_inc = scalar()
-omega_inc = scalar()
-
-head_id = 3
-goal = vec()
+# run the whole rollout inside simulate_steps instead of four launches per step
+use_fused = False
+# accumulate each object's spring impulses over its incident springs (an
+# index built by setup_population) instead of scattering them with atomics
+spring_gather = False
+# Box-box contact: 'none' (boxes only collide with the ground), 'naive'
+# (every pair of boxes is tested) or 'grid' (candidates come from a spatial
+# hash of the box centers, rebuilt every step)
+body_collision = 'none'
+# boxes each box is tested against per step, beyond which contacts are dropped
+max_contacts = 8
+# PhaseProfiler collecting where rollouts spend their time (--profile);
+# None keeps the phase markers down to an empty context manager
+profiler = None
+no_profile = contextlib.nullcontext()
+
+
+def profile_phase(name):
+    return profiler.phase(name) if profiler is not None else no_profile
+
+
+# Fill the actuation of a whole span of steps in one launch before stepping
+# (the rollout, or one checkpoint segment) instead of once per step
+precompute_actuation = False
+# filling is skipped when the state buffer holds fewer steps than this
+# (forward-only rollouts keep two slots), since every fill would then cut a
+# fused launch down to a step or two; control stays in the step instead
+min_actuation_fill = 16
+
+
+def fills_actuation():
+    """Whether actuation is filled ahead of stepping with the current
+    state buffer."""
+    return precompute_actuation and state_slots - 1 >= min_actuation_fill
+
+# Divergence watchdog: every watchdog_interval steps the state is checked
+# for non-finite values and boxes faster than max_speed; forward() stops
+# once every robot of the population has diverged (0 disables)
+watchdog_interval = 64
+max_speed = 100.0
+# steps the last forward() simulated, fewer than asked for when it stopped
+rollout_steps = 0
+
+# Population axis: every state field carries a leading batch index so one
+# kernel launch steps a whole population of robots. Robots with fewer boxes
+# or springs than the padded capacity (n_objects, n_springs) are masked out
+# using their per-robot counts (robot_n_objects, robot_n_springs).
+batch_size = 1
 
 n_objects = 0
 elasticity = 0.0
@@ -59,95 +156,370 @@ spring_omega = 30
 default_actuation = 0.05
 
 n_springs = 0
-spring_anchor_a = ti.field(ti.i32)
-spring_anchor_b = ti.field(ti.i32)
-spring_length = scalar()
-spring_offset_a = vec()
-spring_offset_b = vec()
-spring_phase = scalar()
-spring_actuation = scalar()
-spring_stiffness = scalar()
 
 n_sin_waves = 10
 
 n_hidden = 32
-weights1 = scalar()
-bias1 = scalar()
-hidden = scalar()
-weights2 = scalar()
-bias2 = scalar()
-actuation = scalar()
 
 
 def n_input_states():
     return n_sin_waves + 6 * n_objects + 2
 
 
+def n_checkpoints():
+    return (steps - 2) // checkpoint_interval + 1
+
+
+def field_layout():
+    # settings that decide state_slots and which fields exist, and how large
+    return (forward_only, checkpoint_interval, steps, record_interval,
+            record_capacity, body_collision)
+
+
+# The simulation fields live in their own SNode tree, sized for one
+# (batch_size, n_objects, n_springs) bucket. A population that needs a
+# different bucket frees the tree and allocates a new one; populations in
+# the same bucket reuse it. The settings that shape the tree beyond the
+# sizes (field_layout) must match as well.
+field_tree = None
+field_bucket = None
+field_tree_layout = None
+allocation_stats = {'hits': 0, 'misses': 0, 'alloc_time': 0.0, 'free_time': 0.0}
+
+
+def capacity_bucket(n):
+    """Rounds a count up to the next power of two."""
+    return 1 << max(n - 1, 0).bit_length()
+
+
+def create_fields():
+    global loss, x, v, rotation, omega, halfsize, inverse_mass, \
+        inverse_inertia, v_inc, x_inc, rotation_inc, omega_inc, goal, \
+        robot_n_objects, robot_n_springs, robot_head_id, robot_loss, \
+        robot_failure, robot_failure_step, metric_peak_height, \
+        metric_apex_step, metric_final_height, metric_airtime, metric_flight, \
+        metric_longest_flight, metric_step_low, metric_step_top, \
+        spring_anchor_a, spring_anchor_b, spring_length, spring_offset_a, \
+        spring_offset_b, spring_phase, spring_actuation, spring_stiffness, \
+        spring_frequency, spring_amplitude, \
+        incident_start, incident_spring, linked, contact_count, \
+        contact_object, object_cell, grid_start, \
+        grid_object, weights1, bias1, hidden, weights2, bias2, actuation, \
+        hidden_input, actuation_input, record_x, \
+        record_v, record_rotation, record_omega, record_actuation, \
+        checkpoint_x, checkpoint_v, checkpoint_rotation, checkpoint_omega, \
+        initial_x, initial_v, initial_rotation, initial_omega
+    loss = scalar()
+
+    x = vec()
+    v = vec()
+    rotation = scalar()
+    # angular velocity
+    omega = scalar()
+    # the state every rollout starts from; time slot 0 is reused by later
+    # steps when slots are reused, so it is copied in at each rollout
+    initial_x, initial_v = vec(), vec()
+    initial_rotation, initial_omega = scalar(), scalar()
+
+    halfsize = vec()
+
+    inverse_mass = scalar()
+    inverse_inertia = scalar()
+
+    v_inc = vec()
+    x_inc = vec()
+
+    rotation_inc = scalar()
+    omega_inc = scalar()
+
+    goal = vec()
+
+    robot_n_objects = ti.field(ti.i32)
+    robot_n_springs = ti.field(ti.i32)
+    robot_head_id = ti.field(ti.i32)
+    robot_loss = scalar()
+    # watchdog result per robot: a divergence_reasons code (0 while the
+    # robot is fine) and the first step it was seen at
+    robot_failure = ti.field(ti.i32)
+    robot_failure_step = ti.field(ti.i32)
+    # trajectory metrics per robot, accumulated as the rollout steps: the
+    # highest box center and the step it was reached at, the highest center
+    # at the loss step, the number of steps with no corner on the ground,
+    # the current and the longest run of such steps. step_low / step_top
+    # collect the lowest corner and the highest center of the current step.
+    metric_peak_height = scalar()
+    metric_apex_step = ti.field(ti.i32)
+    metric_final_height = scalar()
+    metric_airtime = ti.field(ti.i32)
+    metric_flight = ti.field(ti.i32)
+    metric_longest_flight = ti.field(ti.i32)
+    metric_step_low = scalar()
+    metric_step_top = scalar()
+
+    spring_anchor_a = ti.field(ti.i32)
+    spring_anchor_b = ti.field(ti.i32)
+    spring_length = scalar()
+    spring_offset_a = vec()
+    spring_offset_b = vec()
+    # central pattern generator of each actuated spring:
+    # amplitude * sin(frequency * time + phase)
+    spring_frequency = scalar()
+    spring_amplitude = scalar()
+    spring_phase = scalar()
+    spring_actuation = scalar()
+    spring_stiffness = scalar()
+    # springs attached to object i of robot b are incident_spring[b, k] // 2
+    # for incident_start[b, i] <= k < incident_start[b, i + 1]; the lowest
+    # bit is 0 when the object is the spring's anchor a, 1 for anchor b
+    incident_start = ti.field(ti.i32)
+    incident_spring = ti.field(ti.i32)
+
+    # spatial hash of each state slot: object_cell is the grid cell of every
+    # box, the boxes in hash bucket h are grid_object[b, t, k] for
+    # grid_start[b, t, h] <= k < grid_start[b, t, h + 1]
+    # linked[b, i, j] is 1 when a spring connects boxes i and j. The boxes
+    # close enough to touch box i at a step are contact_object[b, t, i, c]
+    # for c < contact_count[b, t, i]
+    linked = contact_count = contact_object = None
+    object_cell = grid_start = grid_object = None
+    if body_collision != 'none':
+        linked = ti.field(ti.i8)
+        contact_count = ti.field(ti.i32)
+        contact_object = ti.field(ti.i32)
+    if body_collision == 'grid':
+        object_cell = ti.Vector.field(2, dtype=ti.i32)
+        grid_start = ti.field(ti.i32)
+        grid_object = ti.field(ti.i32)
+
+    weights1 = scalar()
+    bias1 = scalar()
+    hidden = scalar()
+    # pre-activations of the two controller layers
+    hidden_input = scalar()
+    actuation_input = scalar()
+    weights2 = scalar()
+    bias2 = scalar()
+    actuation = scalar()
+
+    record_x = record_v = record_rotation = record_omega = None
+    record_actuation = None
+    if record_interval > 0:
+        record_x, record_v = vec(), vec()
+        record_rotation, record_omega = scalar(), scalar()
+        record_actuation = scalar()
+
+    checkpoint_x = checkpoint_v = None
+    checkpoint_rotation = checkpoint_omega = None
+    if checkpoint_interval > 0 and not forward_only:
+        checkpoint_x, checkpoint_v = vec(), vec()
+        checkpoint_rotation, checkpoint_omega = scalar(), scalar()
+
+
 def allocate_fields():
-    ti.root.dense(ti.i,
-                  max_steps).dense(ti.j,
-                                   n_objects).place(x, v, rotation,
-                                                    rotation_inc, omega, v_inc,
-                                                    x_inc, omega_inc)
-    ti.root.dense(ti.i, n_objects).place(halfsize, inverse_mass,
-                                         inverse_inertia)
-    ti.root.dense(ti.i, n_springs).place(spring_anchor_a, spring_anchor_b,
-                                         spring_length, spring_offset_a,
-                                         spring_offset_b, spring_stiffness,
-                                         spring_phase, spring_actuation)
-    ti.root.dense(ti.ij, (n_hidden, n_input_states())).place(weights1)
-    ti.root.dense(ti.ij, (n_springs, n_hidden)).place(weights2)
-    ti.root.dense(ti.i, n_hidden).place(bias1)
-    ti.root.dense(ti.i, n_springs).place(bias2)
-    ti.root.dense(ti.ij, (max_steps, n_springs)).place(actuation)
-    ti.root.dense(ti.ij, (max_steps, n_hidden)).place(hidden)
-    ti.root.place(loss, goal)
-    ti.root.lazy_grad()
+    """Creates the fields for the current sizes and returns their SNode tree."""
+    global state_slots, reuse_slots
+    if forward_only:
+        state_slots = 2
+    elif checkpoint_interval > 0:
+        state_slots = checkpoint_interval + 1
+    else:
+        assert steps * 2 <= max_steps
+        state_slots = max_steps
+    reuse_slots = state_slots < max_steps
+
+    create_fields()
+    fb = ti.FieldsBuilder()
+    fb.dense(ti.ijk,
+             (batch_size, state_slots,
+              n_objects)).place(x, v, rotation, rotation_inc, omega, v_inc,
+                                x_inc, omega_inc)
+    fb.dense(ti.ij, (batch_size, n_objects)).place(halfsize, inverse_mass,
+                                                   inverse_inertia, initial_x,
+                                                   initial_v, initial_rotation,
+                                                   initial_omega)
+    fb.dense(ti.ij, (batch_size, n_springs)).place(
+        spring_anchor_a, spring_anchor_b, spring_length, spring_offset_a,
+        spring_offset_b, spring_stiffness, spring_frequency, spring_amplitude,
+        spring_phase, spring_actuation)
+    fb.dense(ti.ij, (batch_size, n_objects + 1)).place(incident_start)
+    fb.dense(ti.ij, (batch_size, 2 * n_springs)).place(incident_spring)
+    if body_collision != 'none':
+        fb.dense(ti.ijk, (batch_size, n_objects, n_objects)).place(linked)
+        fb.dense(ti.ijk, (batch_size, state_slots, n_objects)).place(
+            contact_count)
+        fb.dense(ti.ijkl, (batch_size, state_slots, n_objects,
+                           max_contacts)).place(contact_object)
+    if body_collision == 'grid':
+        fb.dense(ti.ijk, (batch_size, state_slots, n_objects)).place(
+            object_cell, grid_object)
+        fb.dense(ti.ijk,
+                 (batch_size, state_slots, n_objects + 1)).place(grid_start)
+    fb.dense(ti.ijk, (batch_size, n_hidden, n_input_states())).place(weights1)
+    fb.dense(ti.ijk, (batch_size, n_springs, n_hidden)).place(weights2)
+    fb.dense(ti.ij, (batch_size, n_hidden)).place(bias1)
+    fb.dense(ti.ij, (batch_size, n_springs)).place(bias2)
+    fb.dense(ti.ijk, (batch_size, state_slots, n_springs)).place(
+        actuation, actuation_input)
+    fb.dense(ti.ijk, (batch_size, state_slots, n_hidden)).place(
+        hidden, hidden_input)
+    fb.dense(ti.i, batch_size).place(robot_n_objects, robot_n_springs,
+                                     robot_head_id, robot_loss,
+                                     robot_failure, robot_failure_step,
+                                     metric_peak_height, metric_apex_step,
+                                     metric_final_height, metric_airtime,
+                                     metric_flight, metric_longest_flight,
+                                     metric_step_low, metric_step_top)
+    fb.place(loss, goal)
+    if record_interval > 0:
+        fb.dense(ti.ijk,
+                 (batch_size, record_capacity,
+                  n_objects)).place(record_x, record_v, record_rotation,
+                                    record_omega)
+        fb.dense(ti.ijk, (batch_size, record_capacity,
+                          n_springs)).place(record_actuation)
+    if checkpoint_interval > 0 and not forward_only:
+        fb.dense(ti.ijk,
+                 (batch_size, n_checkpoints(),
+                  n_objects)).place(checkpoint_x, checkpoint_v,
+                                    checkpoint_rotation, checkpoint_omega)
+    if not forward_only:
+        fb.lazy_grad()
+    return fb.finalize()
 
 
 dt = 0.001
 learning_rate = 0.25
+# simulated seconds per rollout; --dt without --steps keeps this duration
+duration = steps * dt
+# 'explicit' applies spring forces from the current stretch; 'implicit'
+# solves each spring's impulse with backward Euler along the spring, which
+# stays stable with stiff springs at much larger dt
+spring_solver = 'explicit'
+
+
+@ti.func
+def nn_input(b, t, k):
+    # input k of robot b's controller at step t, in the layout of weights1:
+    # the sine waves, six state values per object, then the goal
+    value = 0.0
+    if k < n_sin_waves:
+        value = ti.sin(spring_omega * t * dt + 2 * math.pi / n_sin_waves * k)
+    elif k < n_sin_waves + 6 * n_objects:
+        j = (k - n_sin_waves) // 6
+        c = (k - n_sin_waves) % 6
+        if j < robot_n_objects[b]:
+            offset = x[b, slot(t), j] - x[b, slot(t), robot_head_id[b]]
+            if c == 0:
+                value = offset[0]
+            elif c == 1:
+                value = offset[1]
+            elif c == 2:
+                value = v[b, slot(t), j][0]
+            elif c == 3:
+                value = v[b, slot(t), j][1]
+            elif c == 4:
+                value = rotation[b, slot(t), j]
+            else:
+                value = omega[b, slot(t), j]
+            # use a smaller weight since there are too many of them
+            value *= 0.05
+    elif k == n_sin_waves + 6 * n_objects:
+        value = goal[None][0]
+    else:
+        value = goal[None][1]
+    return value
+
+
+# inputs per tile of the controller's matrix-vector products
+nn_tile = 8
 
 
 @ti.kernel
 def nn1(t: ti.i32):
-    for i in range(n_hidden):
+    # The hidden layer as a tiled matrix-vector product: one thread per
+    # (robot, unit, tile of nn_tile inputs), so the kernel does not grow
+    # with the robot like nn1_unrolled. Tiles are summed in hidden_input
+    # because reverse-mode AD gets local sums over runtime loops wrong.
+    for b, i in ti.ndrange(batch_size, n_hidden):
+        hidden_input[b, slot(t), i] = bias1[b, i]
+    for b, i, tile in ti.ndrange(batch_size, n_hidden,
+                                 ti.static((n_input_states() + nn_tile - 1) // nn_tile)):
+        partial = 0.0
+        for m in ti.static(range(nn_tile)):
+            k = tile * nn_tile + m
+            if k < ti.static(n_input_states()):
+                partial += weights1[b, i, k] * nn_input(b, t, k)
+        hidden_input[b, slot(t), i] += partial
+    for b, i in ti.ndrange(batch_size, n_hidden):
+        hidden[b, slot(t), i] = ti.tanh(hidden_input[b, slot(t), i])
+
+
+@ti.kernel
+def nn2(t: ti.i32):
+    for b, i in ti.ndrange(batch_size, n_springs):
+        actuation_input[b, slot(t), i] = bias2[b, i]
+    for b, i, tile in ti.ndrange(batch_size, n_springs,
+                                 ti.static(n_hidden // nn_tile)):
+        if i < robot_n_springs[b]:
+            partial = 0.0
+            for m in ti.static(range(nn_tile)):
+                j = tile * nn_tile + m
+                partial += weights2[b, i, j] * hidden[b, slot(t), j]
+            actuation_input[b, slot(t), i] += partial
+    for b, i in ti.ndrange(batch_size, n_springs):
+        if i < robot_n_springs[b]:
+            actuation[b, slot(t), i] = ti.tanh(actuation_input[b, slot(t), i])
+
+
+@ti.kernel
+def nn1_unrolled(t: ti.i32):
+    # nn1 with the input loops unrolled at compile time
+    for b, i in ti.ndrange(batch_size, n_hidden):
         actuation = 0.0
         for j in ti.static(range(n_sin_waves)):
-            actuation += weights1[i, j] * ti.sin(spring_omega * t * dt +
-                                                 2 * math.pi / n_sin_waves * j)
+            actuation += weights1[b, i, j] * ti.sin(spring_omega * t * dt +
+                                                    2 * math.pi / n_sin_waves * j)
+        h = robot_head_id[b]
         for j in ti.static(range(n_objects)):
-            offset = x[t, j] - x[t, head_id]
-            # use a smaller weight since there are too many of them
-            actuation += weights1[i, j * 6 + n_sin_waves] * offset[0] * 0.05
-            actuation += weights1[i,
-                                  j * 6 + n_sin_waves + 1] * offset[1] * 0.05
-            actuation += weights1[i, j * 6 + n_sin_waves + 2] * v[t,
-                                                                  j][0] * 0.05
-            actuation += weights1[i, j * 6 + n_sin_waves + 3] * v[t,
-                                                                  j][1] * 0.05
-            actuation += weights1[i, j * 6 + n_sin_waves +
-                                  4] * rotation[t, j] * 0.05
-            actuation += weights1[i, j * 6 + n_sin_waves + 5] * omega[t,
-                                                                      j] * 0.05
-
-        actuation += weights1[i, n_objects * 6 + n_sin_waves] * goal[None][0]
-        actuation += weights1[i,
+            if j < robot_n_objects[b]:
+                offset = x[b, slot(t), j] - x[b, slot(t), h]
+                # use a smaller weight since there are too many of them
+                actuation += weights1[b, i, j * 6 + n_sin_waves] * offset[0] * 0.05
+                actuation += weights1[b, i, j * 6 + n_sin_waves +
+                                      1] * offset[1] * 0.05
+                actuation += weights1[b, i, j * 6 + n_sin_waves +
+                                      2] * v[b, slot(t), j][0] * 0.05
+                actuation += weights1[b, i, j * 6 + n_sin_waves +
+                                      3] * v[b, slot(t), j][1] * 0.05
+                actuation += weights1[b, i, j * 6 + n_sin_waves +
+                                      4] * rotation[b, slot(t), j] * 0.05
+                actuation += weights1[b, i, j * 6 + n_sin_waves +
+                                      5] * omega[b, slot(t), j] * 0.05
+
+        actuation += weights1[b, i, n_objects * 6 + n_sin_waves] * goal[None][0]
+        actuation += weights1[b, i,
                               n_objects * 6 + n_sin_waves + 1] * goal[None][1]
-        actuation += bias1[i]
+        actuation += bias1[b, i]
         actuation = ti.tanh(actuation)
-        hidden[t, i] = actuation
+        hidden[b, slot(t), i] = actuation
 
 
 @ti.kernel
-def nn2(t: ti.i32):
-    for i in range(n_springs):
-        act = 0.0
-        for j in ti.static(range(n_hidden)):
-            act += weights2[i, j] * hidden[t, j]
-        act += bias2[i]
-        act = ti.tanh(act)
-        actuation[t, i] = act
+def nn2_unrolled(t: ti.i32):
+    for b, i in ti.ndrange(batch_size, n_springs):
+        if i < robot_n_springs[b]:
+            act = 0.0
+            for j in ti.static(range(n_hidden)):
+                act += weights2[b, i, j] * hidden[b, slot(t), j]
+            act += bias2[b, i]
+            act = ti.tanh(act)
+            actuation[b, slot(t), i] = act
+
+
+@ti.func
+def slot(t):
+    # time step -> index into the state fields
+    return t % state_slots
 
 
 @ti.func
@@ -155,285 +527,1099 @@ def rotation_matrix(r):
     return ti.Matrix([[ti.cos(r), -ti.sin(r)], [ti.sin(r), ti.cos(r)]])
 
 
+@ti.func
+def restore_initial_state():
+    for b, i in ti.ndrange(batch_size, n_objects):
+        x[b, 0, i] = initial_x[b, i]
+        v[b, 0, i] = initial_v[b, i]
+        rotation[b, 0, i] = initial_rotation[b, i]
+        omega[b, 0, i] = initial_omega[b, i]
+
+
+@ti.kernel
+def reset_initial_state():
+    # rollouts overwrite slot 0 when slots are reused, so each one starts by
+    # copying the setup state back; its gradient flows into initial_*
+    restore_initial_state()
+
+
 @ti.kernel
 def initialize_properties():
-    for i in range(n_objects):
-        inverse_mass[i] = 1.0 / (4 * halfsize[i][0] * halfsize[i][1])
-        inverse_inertia[i] = 1.0 / (4 / 3 * halfsize[i][0] * halfsize[i][1] *
-                                    (halfsize[i][0] * halfsize[i][0] +
-                                     halfsize[i][1] * halfsize[i][1]))
+    for b, i in ti.ndrange(batch_size, n_objects):
+        if i < robot_n_objects[b]:
+            inverse_mass[b, i] = 1.0 / (4 * halfsize[b, i][0] *
+                                        halfsize[b, i][1])
+            inverse_inertia[b, i] = 1.0 / (
+                4 / 3 * halfsize[b, i][0] * halfsize[b, i][1] *
+                (halfsize[b, i][0] * halfsize[b, i][0] +
+                 halfsize[b, i][1] * halfsize[b, i][1]))
 
 
 @ti.func
-def to_world(t, i, rela_x):
-    rot = rotation[t, i]
+def to_world(b, t, i, rela_x):
+    rot = rotation[b, slot(t), i]
     rot_matrix = rotation_matrix(rot)
 
     rela_pos = rot_matrix @ rela_x
-    rela_v = omega[t, i] * ti.Vector([-rela_pos[1], rela_pos[0]])
+    rela_v = omega[b, slot(t), i] * ti.Vector([-rela_pos[1], rela_pos[0]])
 
-    world_x = x[t, i] + rela_pos
-    world_v = v[t, i] + rela_v
+    world_x = x[b, slot(t), i] + rela_pos
+    world_v = v[b, slot(t), i] + rela_v
 
     return world_x, world_v, rela_pos
 
 
 @ti.func
-def apply_impulse(t, i, impulse, location, toi_input):
-    delta_v = impulse * inverse_mass[i]
-    delta_omega = (location - x[t, i]).cross(impulse) * inverse_inertia[i]
+def apply_impulse(b, t, i, impulse, location, toi_input):
+    delta_v = impulse * inverse_mass[b, i]
+    delta_omega = (location - x[b, slot(t), i]).cross(impulse) * inverse_inertia[b, i]
 
     toi = ti.min(ti.max(0.0, toi_input), dt)
 
-    ti.atomic_add(x_inc[t + 1, i], toi * (-delta_v))
-    ti.atomic_add(rotation_inc[t + 1, i], toi * (-delta_omega))
+    ti.atomic_add(x_inc[b, slot(t + 1), i], toi * (-delta_v))
+    ti.atomic_add(rotation_inc[b, slot(t + 1), i], toi * (-delta_omega))
+
+    ti.atomic_add(v_inc[b, slot(t + 1), i], delta_v)
+    ti.atomic_add(omega_inc[b, slot(t + 1), i], delta_omega)
 
-    ti.atomic_add(v_inc[t + 1, i], delta_v)
-    ti.atomic_add(omega_inc[t + 1, i], delta_omega)
+
+@ti.func
+def collide_object(b, t, i):
+    hs = halfsize[b, i]
+    for k in ti.static(range(4)):
+        # the corner for collision detection
+        offset_scale = ti.Vector([k % 2 * 2 - 1, k // 2 % 2 * 2 - 1])
+
+        corner_x, corner_v, rela_pos = to_world(b, t, i, offset_scale * hs)
+        corner_v = corner_v + dt * gravity * ti.Vector([0.0, 1.0])
+
+        # Apply impulse so that there's no sinking
+        normal = ti.Vector([0.0, 1.0])
+        tao = ti.Vector([1.0, 0.0])
+
+        rn = rela_pos.cross(normal)
+        rt = rela_pos.cross(tao)
+        impulse_contribution = inverse_mass[b, i] + (rn) ** 2 * \
+                               inverse_inertia[b, i]
+        timpulse_contribution = inverse_mass[b, i] + (rt) ** 2 * \
+                                inverse_inertia[b, i]
+
+        rela_v_ground = normal.dot(corner_v)
+
+        impulse = 0.0
+        timpulse = 0.0
+        new_corner_x = corner_x + dt * corner_v
+        toi = 0.0
+        if rela_v_ground < 0 and new_corner_x[1] < ground_height:
+            impulse = -(1 +
+                        elasticity) * rela_v_ground / impulse_contribution
+            if impulse > 0:
+                # friction
+                timpulse = -corner_v.dot(tao) / timpulse_contribution
+                timpulse = ti.min(friction * impulse,
+                                  ti.max(-friction * impulse, timpulse))
+                if corner_x[1] > ground_height:
+                    toi = -(corner_x[1] - ground_height) / ti.min(
+                        corner_v[1], -1e-3)
+
+        apply_impulse(b, t, i, impulse * normal + timpulse * tao,
+                      new_corner_x, toi)
+
+        penalty = 0.0
+        if new_corner_x[1] < ground_height:
+            # apply penalty
+            penalty = -dt * penalty * (
+                new_corner_x[1] - ground_height) / impulse_contribution
+
+        apply_impulse(b, t, i, penalty * normal, new_corner_x, 0)
 
 
 @ti.kernel
 def collide(t: ti.i32):
-    for i in range(n_objects):
-        hs = halfsize[i]
-        for k in ti.static(range(4)):
-            # the corner for collision detection
-            offset_scale = ti.Vector([k % 2 * 2 - 1, k // 2 % 2 * 2 - 1])
-
-            corner_x, corner_v, rela_pos = to_world(t, i, offset_scale * hs)
-            corner_v = corner_v + dt * gravity * ti.Vector([0.0, 1.0])
-
-            # Apply impulse so that there's no sinking
-            normal = ti.Vector([0.0, 1.0])
-            tao = ti.Vector([1.0, 0.0])
-
-            rn = rela_pos.cross(normal)
-            rt = rela_pos.cross(tao)
-            impulse_contribution = inverse_mass[i] + (rn) ** 2 * \
-                                   inverse_inertia[i]
-            timpulse_contribution = inverse_mass[i] + (rt) ** 2 * \
-                                    inverse_inertia[i]
-
-            rela_v_ground = normal.dot(corner_v)
-
-            impulse = 0.0
-            timpulse = 0.0
-            new_corner_x = corner_x + dt * corner_v
-            toi = 0.0
-            if rela_v_ground < 0 and new_corner_x[1] < ground_height:
-                impulse = -(1 +
-                            elasticity) * rela_v_ground / impulse_contribution
-                if impulse > 0:
-                    # friction
-                    timpulse = -corner_v.dot(tao) / timpulse_contribution
-                    timpulse = ti.min(friction * impulse,
-                                      ti.max(-friction * impulse, timpulse))
-                    if corner_x[1] > ground_height:
-                        toi = -(corner_x[1] - ground_height) / ti.min(
-                            corner_v[1], -1e-3)
-
-            apply_impulse(t, i, impulse * normal + timpulse * tao,
-                          new_corner_x, toi)
-
-            penalty = 0.0
-            if new_corner_x[1] < ground_height:
-                # apply penalty
-                penalty = -dt * penalty * (
-                    new_corner_x[1] - ground_height) / impulse_contribution
-
-            apply_impulse(t, i, penalty * normal, new_corner_x, 0)
-
-
-@ti.kernel
-def apply_spring_force(t: ti.i32):
-    for i in range(n_springs):
-        a = spring_anchor_a[i]
-        b = spring_anchor_b[i]
-        pos_a, vel_a, rela_a = to_world(t, a, spring_offset_a[i])
-        pos_b, vel_b, rela_b = to_world(t, b, spring_offset_b[i])
-        dist = pos_a - pos_b
-        length = dist.norm() + 1e-4
-
-        act = actuation[t, i]
-
-        is_joint = spring_length[i] == -1
-
-        target_length = spring_length[i] * (1.0 + spring_actuation[i] * act)
-        if is_joint:
-            target_length = 0.0
-        impulse = dt * (length -
-                        target_length) * spring_stiffness[i] / length * dist
-
-        if is_joint:
-            rela_vel = vel_a - vel_b
-            rela_vel_norm = rela_vel.norm() + 1e-1
-            impulse_dir = rela_vel / rela_vel_norm
-            impulse_contribution = inverse_mass[a] + \
-              impulse_dir.cross(rela_a) ** 2 * inverse_inertia[
-                                     a] + inverse_mass[b] + impulse_dir.cross(rela_b) ** 2 * \
-                                   inverse_inertia[
-                                     b]
-            # project relative velocity
-            impulse += rela_vel_norm / impulse_contribution * impulse_dir
-
-        apply_impulse(t, a, -impulse, pos_a, 0.0)
-        apply_impulse(t, b, impulse, pos_b, 0.0)
+    for b, i in ti.ndrange(batch_size, n_objects):
+        if i < robot_n_objects[b]:
+            collide_object(b, t, i)
+
+
+@ti.func
+def box_contact(b, t, i, j):
+    # Pushes the corners of box i that are inside box j out through the
+    # nearest face of j, with equal and opposite impulses on both boxes.
+    hs = halfsize[b, j]
+    # rotation of j written out: matrix products accumulate into locals,
+    # which reverse-mode AD does not support inside the contact loop
+    c = ti.cos(rotation[b, slot(t), j])
+    s = ti.sin(rotation[b, slot(t), j])
+    for k in ti.static(range(4)):
+        offset_scale = ti.Vector([k % 2 * 2 - 1, k // 2 % 2 * 2 - 1])
+        corner_x, corner_v, rela_i = to_world(b, t, i,
+                                              offset_scale * halfsize[b, i])
+        rela_j = corner_x - x[b, slot(t), j]
+        local = ti.Vector([c * rela_j[0] + s * rela_j[1],
+                           c * rela_j[1] - s * rela_j[0]])
+        depth = hs - ti.abs(local)
+        if depth[0] > 0 and depth[1] > 0:
+            x_face = depth[0] < depth[1]
+            face = ti.Vector([ti.math.sign(local[0]) * x_face,
+                              ti.math.sign(local[1]) * (1 - x_face)])
+            normal = ti.Vector([c * face[0] - s * face[1],
+                                s * face[0] + c * face[1]])
+            corner_v_j = v[b, slot(t), j] + omega[b, slot(t), j] * ti.Vector(
+                [-rela_j[1], rela_j[0]])
+            rela_v = normal.dot(corner_v - corner_v_j)
+            impulse_contribution = inverse_mass[b, i] + \
+                rela_i.cross(normal) ** 2 * inverse_inertia[b, i] + \
+                inverse_mass[b, j] + \
+                rela_j.cross(normal) ** 2 * inverse_inertia[b, j]
+            # no bounce beyond elasticity, plus a penalty on the overlap
+            impulse = (ti.max(-(1 + elasticity) * rela_v, 0.0) +
+                       dt * penalty * ti.min(depth[0], depth[1])) / \
+                impulse_contribution
+            apply_impulse(b, t, i, impulse * normal, corner_x, 0.0)
+            apply_impulse(b, t, j, -impulse * normal, corner_x, 0.0)
+
+
+@ti.func
+def add_contact(b, t, i, j, count):
+    # boxes joined by a spring may overlap by design and never collide
+    reach = halfsize[b, i].norm() + halfsize[b, j].norm()
+    if j != i and linked[b, i, j] == 0 and count < max_contacts:
+        if (x[b, slot(t), i] - x[b, slot(t), j]).norm() < reach:
+            contact_object[b, slot(t), i, count] = j
+            count += 1
+    return count
+
+
+@ti.func
+def cell_hash(cell):
+    return ((cell[0] * 73856093) ^ (cell[1] * 19349663)) & (n_objects - 1)
+
+
+@ti.ad.no_grad
+@ti.kernel
+def build_grid(t: ti.i32):
+    # Counting sort of the boxes of each robot into n_objects hash buckets.
+    # Cells are as wide as the largest box, so boxes that may touch lie in
+    # the same or neighbouring cells.
+    for b in range(batch_size):
+        n = robot_n_objects[b]
+        cell_size = 1e-6
+        for i in range(n):
+            cell_size = ti.max(cell_size, 2 * halfsize[b, i].norm())
+        for h in range(n_objects + 1):
+            grid_start[b, slot(t), h] = 0
+        for i in range(n):
+            cell = ti.floor(x[b, slot(t), i] / cell_size, ti.i32)
+            object_cell[b, slot(t), i] = cell
+            grid_start[b, slot(t), cell_hash(cell)] += 1
+        # bucket ends, then filled back to front so they become bucket starts
+        for h in range(1, n_objects + 1):
+            grid_start[b, slot(t), h] += grid_start[b, slot(t), h - 1]
+        for i in range(n):
+            h = cell_hash(object_cell[b, slot(t), i])
+            grid_start[b, slot(t), h] -= 1
+            grid_object[b, slot(t), grid_start[b, slot(t), h]] = i
+
+
+@ti.ad.no_grad
+@ti.kernel
+def find_contacts(t: ti.i32, grid: ti.template()):
+    # Broad phase: lists the boxes each box may touch at step t, either from
+    # the neighbouring grid cells or by testing all pairs.
+    for b, i in ti.ndrange(batch_size, n_objects):
+        count = 0
+        if i < robot_n_objects[b]:
+            if ti.static(grid):
+                cell = object_cell[b, slot(t), i]
+                for d in ti.static(ti.grouped(ti.ndrange((-1, 2), (-1, 2)))):
+                    neighbor = cell + d
+                    h = cell_hash(neighbor)
+                    for k in range(grid_start[b, slot(t), h],
+                                   grid_start[b, slot(t), h + 1]):
+                        j = grid_object[b, slot(t), k]
+                        # buckets are shared by hash collisions
+                        if all(object_cell[b, slot(t), j] == neighbor):
+                            count = add_contact(b, t, i, j, count)
+            else:
+                for j in range(robot_n_objects[b]):
+                    count = add_contact(b, t, i, j, count)
+        contact_count[b, slot(t), i] = count
+
+
+@ti.kernel
+def collide_bodies(t: ti.i32):
+    for b, i in ti.ndrange(batch_size, n_objects):
+        for c in range(contact_count[b, slot(t), i]):
+            box_contact(b, t, i, contact_object[b, slot(t), i, c])
+
+
+def body_collision_launches(t):
+    """The kernels resolving box-box contacts at step t, as (kernel, args)."""
+    if body_collision == 'grid':
+        return [(build_grid, (t,)), (find_contacts, (t, True)),
+                (collide_bodies, (t,))]
+    if body_collision == 'naive':
+        return [(find_contacts, (t, False)), (collide_bodies, (t,))]
+    return []
+
+
+@ti.func
+def degree(b, i):
+    return incident_start[b, i + 1] - incident_start[b, i]
+
+
+@ti.func
+def spring_impulse(b, t, i):
+    ia = spring_anchor_a[b, i]
+    ib = spring_anchor_b[b, i]
+    pos_a, vel_a, rela_a = to_world(b, t, ia, spring_offset_a[b, i])
+    pos_b, vel_b, rela_b = to_world(b, t, ib, spring_offset_b[b, i])
+    dist = pos_a - pos_b
+    length = dist.norm() + 1e-4
+
+    act = actuation[b, slot(t), i]
+
+    is_joint = spring_length[b, i] == -1
+
+    target_length = spring_length[b, i] * (1.0 + spring_actuation[b, i] * act)
+    if is_joint:
+        target_length = 0.0
+    impulse = dt * (length -
+                    target_length) * spring_stiffness[b, i] / length * dist
+    if ti.static(spring_solver == 'implicit'):
+        # the impulse that matches the stretch at the end of the step, with
+        # the velocity change the impulse itself causes: j = dt k (C + dt
+        # dC/dt) / (1 + dt^2 k w), w the inverse mass along the spring
+        direction = dist / length
+        rate = (vel_a - vel_b).dot(direction)
+        inverse_mass_along = inverse_mass[b, ia] + \
+            rela_a.cross(direction) ** 2 * inverse_inertia[b, ia] + \
+            inverse_mass[b, ib] + rela_b.cross(direction) ** 2 * inverse_inertia[b, ib]
+        stiffness = spring_stiffness[b, i]
+        # every spring of a body solves against it independently (Jacobi),
+        # so a body shared by n springs counts n times as heavy
+        inverse_mass_along *= ti.max(degree(b, ia), degree(b, ib))
+        impulse = dt * stiffness * (length - target_length + dt * rate) / (
+            1 + dt * dt * stiffness * inverse_mass_along) * direction
+
+    if is_joint:
+        rela_vel = vel_a - vel_b
+        rela_vel_norm = rela_vel.norm() + 1e-1
+        impulse_dir = rela_vel / rela_vel_norm
+        impulse_contribution = inverse_mass[b, ia] + \
+          impulse_dir.cross(rela_a) ** 2 * inverse_inertia[
+                                 b, ia] + inverse_mass[b, ib] + impulse_dir.cross(rela_b) ** 2 * \
+                               inverse_inertia[
+                                 b, ib]
+        if ti.static(spring_solver == 'implicit'):
+            impulse_contribution *= ti.max(degree(b, ia), degree(b, ib))
+        # project relative velocity
+        impulse += rela_vel_norm / impulse_contribution * impulse_dir
+
+    return impulse, pos_a, pos_b
+
+
+@ti.func
+def spring_force(b, t, i):
+    impulse, pos_a, pos_b = spring_impulse(b, t, i)
+    apply_impulse(b, t, spring_anchor_a[b, i], -impulse, pos_a, 0.0)
+    apply_impulse(b, t, spring_anchor_b[b, i], impulse, pos_b, 0.0)
+
+
+@ti.func
+def gather_spring_force(b, t, i):
+    # Sums the impulses of the springs attached to object i in registers and
+    # adds them to the object once, so each object's increments are written
+    # by a single thread (unlike the scatter in spring_force, where every
+    # spring of the hub hits the same object). Every spring is evaluated
+    # once per end.
+    dv = ti.Vector([0.0, 0.0])
+    domega = 0.0
+    for k in range(incident_start[b, i], incident_start[b, i + 1]):
+        impulse, pos_a, pos_b = spring_impulse(b, t, incident_spring[b, k] // 2)
+        # anchor a receives -impulse at pos_a, anchor b +impulse at pos_b
+        side = incident_spring[b, k] % 2
+        signed_impulse = (2 * side - 1) * impulse
+        location = pos_a + side * (pos_b - pos_a)
+        dv += signed_impulse
+        domega += (location - x[b, slot(t), i]).cross(signed_impulse)
+    # a plain read and write, as no other thread touches object i here
+    v_inc[b, slot(t + 1), i] = v_inc[b, slot(t + 1), i] + dv * inverse_mass[b, i]
+    omega_inc[b, slot(t + 1), i] = omega_inc[b, slot(t + 1), i] + \
+        domega * inverse_inertia[b, i]
+
+
+@ti.kernel
+def scatter_spring_forces(t: ti.i32):
+    for b, i in ti.ndrange(batch_size, n_springs):
+        if i < robot_n_springs[b]:
+            spring_force(b, t, i)
+
+
+@ti.kernel
+def gather_spring_forces(t: ti.i32):
+    for b, i in ti.ndrange(batch_size, n_objects):
+        if i < robot_n_objects[b]:
+            gather_spring_force(b, t, i)
+
+
+@ti.ad.grad_replaced
+def apply_spring_force(t):
+    if spring_gather:
+        gather_spring_forces(t)
+    else:
+        scatter_spring_forces(t)
+
+
+@ti.ad.grad_for(apply_spring_force)
+def apply_spring_force_grad(t):
+    # Taichi's reverse mode gets the register sums of gather_spring_force
+    # wrong (a local carried across a loop with a runtime trip count), so
+    # both paths are differentiated through the scatter, which adds the
+    # same impulses to the same objects
+    scatter_spring_forces.grad(t)
+
+
+@ti.func
+def advance_object(b, t, i, toi: ti.template()):
+    s = ti.exp(-dt * damping)
+    v[b, slot(t), i] = s * v[b, slot(t - 1), i] + v_inc[b, slot(t), i] + dt * gravity * \
+                 ti.Vector([0.0, 1.0])
+    omega[b, slot(t), i] = s * omega[b, slot(t - 1), i] + omega_inc[b, slot(t), i]
+    if ti.static(toi):
+        x[b, slot(t), i] = x[b, slot(t - 1), i] + dt * v[b, slot(t), i] + x_inc[b, slot(t), i]
+        rotation[b, slot(t), i] = rotation[b, slot(t - 1), i] + dt * omega[
+            b, slot(t), i] + rotation_inc[b, slot(t), i]
+    else:
+        x[b, slot(t), i] = x[b, slot(t - 1), i] + dt * v[b, slot(t), i]
+        rotation[b, slot(t), i] = rotation[b, slot(t - 1), i] + dt * omega[b, slot(t), i]
 
 
 @ti.kernel
 def advance_toi(t: ti.i32):
-    for i in range(n_objects):
-        s = ti.exp(-dt * damping)
-        v[t, i] = s * v[t - 1, i] + v_inc[t, i] + dt * gravity * ti.Vector(
-            [0.0, 1.0])
-        x[t, i] = x[t - 1, i] + dt * v[t, i] + x_inc[t, i]
-        omega[t, i] = s * omega[t - 1, i] + omega_inc[t, i]
-        rotation[t, i] = rotation[t - 1,
-                                  i] + dt * omega[t, i] + rotation_inc[t, i]
+    for b, i in ti.ndrange(batch_size, n_objects):
+        if i < robot_n_objects[b]:
+            advance_object(b, t, i, True)
 
 
 @ti.kernel
 def advance_no_toi(t: ti.i32):
-    for i in range(n_objects):
-        s = math.exp(-dt * damping)
-        v[t, i] = s * v[t - 1, i] + v_inc[t, i] + dt * gravity * ti.Vector(
-            [0.0, 1.0])
-        x[t, i] = x[t - 1, i] + dt * v[t, i]
-        omega[t, i] = s * omega[t - 1, i] + omega_inc[t, i]
-        rotation[t, i] = rotation[t - 1, i] + dt * omega[t, i]
+    for b, i in ti.ndrange(batch_size, n_objects):
+        if i < robot_n_objects[b]:
+            advance_object(b, t, i, False)
 
 
 @ti.kernel
 def compute_loss(t: ti.i32):
-    loss[None] = (x[t, head_id] - goal[None]).norm()
+    for b in range(batch_size):
+        if robot_n_objects[b] > 0:
+            l = (x[b, slot(t), robot_head_id[b]] - goal[None]).norm()
+            robot_loss[b] = l
+            loss[None] += l
+
+
+class RolloutFailure(NamedTuple):
+    """A robot whose rollout diverged, with the step it was detected at."""
+    robot: int
+    step: int
+    reason: str
+
+
+divergence_reasons = {1: 'speed limit exceeded', 2: 'non-finite state'}
+
+
+@ti.ad.no_grad
+@ti.kernel
+def reset_watchdog():
+    for b in range(batch_size):
+        robot_failure[b] = 0
+        robot_failure_step[b] = 2**30
+
+
+@ti.ad.no_grad
+@ti.kernel
+def check_divergence(t: ti.i32):
+    for b, i in ti.ndrange(batch_size, n_objects):
+        if i < robot_n_objects[b]:
+            state = ti.Vector([x[b, slot(t), i][0], x[b, slot(t), i][1],
+                               v[b, slot(t), i][0], v[b, slot(t), i][1],
+                               rotation[b, slot(t), i], omega[b, slot(t), i]])
+            reason = 0
+            if any(ti.math.isnan(state)) or any(ti.math.isinf(state)):
+                reason = 2
+            elif v[b, slot(t), i].norm() > max_speed:
+                reason = 1
+            if reason > 0:
+                ti.atomic_max(robot_failure[b], reason)
+                ti.atomic_min(robot_failure_step[b], t)
+
+
+def rollout_failures():
+    """The robots the watchdog flagged in the last rollout."""
+    codes = robot_failure.to_numpy()
+    detected = robot_failure_step.to_numpy()
+    return [RolloutFailure(b, int(detected[b]), divergence_reasons[codes[b]])
+            for b in range(batch_size) if codes[b]]
+
+
+def watchdog_due(t):
+    return watchdog_interval > 0 and t % watchdog_interval == 0
+
+
+def population_diverged(t):
+    """Checks step t and returns whether every robot has diverged."""
+    check_divergence(t)
+    codes = robot_failure.to_numpy()
+    return bool(np.all(codes[robot_n_objects.to_numpy() > 0] > 0))
+
+
+class RolloutMetrics(NamedTuple):
+    """How high and how long a robot flew during the last rollout.
+
+    Heights are box centers, times are in seconds. A robot is in flight
+    while none of its box corners touches the ground.
+    """
+    peak_height: float
+    apex_time: float
+    final_height: float
+    airtime: float
+    longest_flight: float
+
+
+@ti.ad.no_grad
+@ti.kernel
+def reset_metrics():
+    for b in range(batch_size):
+        metric_peak_height[b] = -math.inf
+        metric_apex_step[b] = 0
+        metric_final_height[b] = math.nan
+        metric_airtime[b] = 0
+        metric_flight[b] = 0
+        metric_longest_flight[b] = 0
+        metric_step_low[b] = math.inf
+        metric_step_top[b] = -math.inf
+
+
+@ti.func
+def track_object(b, t, i):
+    # folds box i into the extremes of robot b at step t
+    p = x[b, slot(t), i]
+    c = ti.cos(rotation[b, slot(t), i])
+    s = ti.sin(rotation[b, slot(t), i])
+    lowest = p[1] - ti.abs(s) * halfsize[b, i][0] - ti.abs(c) * halfsize[b, i][1]
+    ti.atomic_min(metric_step_low[b], lowest)
+    ti.atomic_max(metric_step_top[b], p[1])
+
+
+@ti.func
+def finish_metrics_step(b, t):
+    # called once every box of robot b has been tracked for step t
+    if metric_step_top[b] > metric_peak_height[b]:
+        metric_peak_height[b] = metric_step_top[b]
+        metric_apex_step[b] = t
+    if t == steps - 1:
+        metric_final_height[b] = metric_step_top[b]
+    if metric_step_low[b] > ground_height:
+        metric_airtime[b] += 1
+        metric_flight[b] += 1
+        metric_longest_flight[b] = ti.max(metric_longest_flight[b],
+                                          metric_flight[b])
+    else:
+        metric_flight[b] = 0
+    metric_step_low[b] = math.inf
+    metric_step_top[b] = -math.inf
+
+
+@ti.ad.no_grad
+@ti.kernel
+def accumulate_metrics(t: ti.i32):
+    for b, i in ti.ndrange(batch_size, n_objects):
+        if i < robot_n_objects[b]:
+            track_object(b, t, i)
+    for b in range(batch_size):
+        if robot_n_objects[b] > 0:
+            finish_metrics_step(b, t)
 
 
+@ti.ad.no_grad
 @ti.kernel
+def accumulate_metrics_range(t_begin: ti.i32, t_end: ti.i32):
+    # the same for the stored steps t_begin..t_end-1 of a fused launch
+    for b in range(batch_size):
+        for t in range(t_begin, t_end):
+            for i in range(robot_n_objects[b]):
+                track_object(b, t, i)
+            finish_metrics_step(b, t)
+
+
+def rollout_metrics():
+    """RolloutMetrics of every robot in the population, None for empty slots."""
+    counts = robot_n_objects.to_numpy()
+    peak = metric_peak_height.to_numpy()
+    apex = metric_apex_step.to_numpy()
+    final = metric_final_height.to_numpy()
+    airtime = metric_airtime.to_numpy()
+    longest = metric_longest_flight.to_numpy()
+    return [RolloutMetrics(float(peak[b]), apex[b] * dt, float(final[b]),
+                           airtime[b] * dt, longest[b] * dt)
+            if counts[b] else None for b in range(batch_size)]
+
+
 # Applies open-loop control patterns to the springs.
+@ti.func
+def open_loop_control(b, t, i):
+    # Each actuated spring follows its own sinusoidal pattern generator.
+    if spring_actuation[b, i] > 0:
+        actuation[b, slot(t), i] = spring_amplitude[b, i] * ti.sin(
+            spring_frequency[b, i] * t * dt + spring_phase[b, i])
+
+
+@ti.kernel
 def apply_open_loop_control(t: ti.i32):
-    # Implements sinusoidal patterns with phase differences based on spring position.
-    for i in range(n_springs):
-        if spring_actuation[i] > 0: 
-            
-            frequency = 5.0  # Hz - controls speed of oscillation
-            amplitude = 1.0  # Controls strength of actuation
-            
-            phase = 2 * math.pi * (i % 4) / 4  # Different phases for different springs
-            
-            actuation_value = amplitude * ti.sin(frequency * t * dt + phase)
-            actuation[t, i] = actuation_value
+    for b, i in ti.ndrange(batch_size, n_springs):
+        if i < robot_n_springs[b]:
+            open_loop_control(b, t, i)
+
+
+@ti.kernel
+def fill_actuation(t_begin: ti.i32, t_end: ti.i32):
+    # the open-loop control of steps t_begin..t_end-1 in one launch; the
+    # range must fit in the state slots
+    for b, t, i in ti.ndrange(batch_size, (t_begin, t_end), n_springs):
+        if i < robot_n_springs[b]:
+            open_loop_control(b, t, i)
+
+
+def default_cpg(n_springs):
+    """Pattern generator rows (frequency, amplitude, phase) of the original
+    controller: 5 rad/s at full amplitude, phases cycling in quarter turns."""
+    return np.array([(5.0, 1.0, 2 * math.pi * (i % 4) / 4)
+                     for i in range(n_springs)]).reshape(-1, 3)
+
+
+@ti.func
+def clear_increments(b, t, i):
+    v_inc[b, slot(t), i] = ti.Vector([0.0, 0.0])
+    x_inc[b, slot(t), i] = ti.Vector([0.0, 0.0])
+    rotation_inc[b, slot(t), i] = 0.0
+    omega_inc[b, slot(t), i] = 0.0
+
+
+@ti.kernel
+def clear_step(t: ti.i32):
+    # the ring buffer reuses slots, so increments are zeroed before each step
+    for b, i in ti.ndrange(batch_size, n_objects):
+        clear_increments(b, t, i)
+
+
+@ti.func
+def record_item(b, t, i):
+    k = t // record_interval % record_capacity
+    if i < robot_n_objects[b]:
+        record_x[b, k, i] = x[b, slot(t), i]
+        record_v[b, k, i] = v[b, slot(t), i]
+        record_rotation[b, k, i] = rotation[b, slot(t), i]
+        record_omega[b, k, i] = omega[b, slot(t), i]
+    if i < robot_n_springs[b]:
+        act = 0.0
+        if t > 0:
+            act = actuation[b, slot(t - 1), i]
+        record_actuation[b, k, i] = act
+
+
+@ti.kernel
+def record_frame(t: ti.i32):
+    for b, i in ti.ndrange(batch_size, ti.static(max(n_objects, n_springs))):
+        record_item(b, t, i)
 
 
-gui = ti.GUI('Rigid Body Simulation', (512, 512), background_color=0xFFFFFF)
+@ti.ad.no_grad
+@ti.kernel
+def copy_record_frames(f_begin: ti.i32, n: ti.i32, out_x: ti.types.ndarray(),
+                       out_v: ti.types.ndarray(),
+                       out_rotation: ti.types.ndarray(),
+                       out_omega: ti.types.ndarray(),
+                       out_actuation: ti.types.ndarray()):
+    # recorded frames f_begin..f_begin+n-1, frame-major
+    for f, b, i in ti.ndrange(n, batch_size, ti.static(max(n_objects, n_springs))):
+        k = (f_begin + f) % record_capacity
+        if i < n_objects:
+            for d in ti.static(range(2)):
+                out_x[f, b, i, d] = record_x[b, k, i][d]
+                out_v[f, b, i, d] = record_v[b, k, i][d]
+            out_rotation[f, b, i] = record_rotation[b, k, i]
+            out_omega[f, b, i] = record_omega[b, k, i]
+        if i < n_springs:
+            out_actuation[f, b, i] = record_actuation[b, k, i]
+
+
+def trajectory_metadata():
+    """Timing, settings and the topology of every robot in the batch."""
+    counts = robot_n_objects.to_numpy()
+    spring_counts = robot_n_springs.to_numpy()
+    heads = robot_head_id.to_numpy()
+    halfsizes = halfsize.to_numpy()
+    tables = {'a': spring_anchor_a, 'b': spring_anchor_b,
+              'offset_a': spring_offset_a, 'offset_b': spring_offset_b,
+              'length': spring_length, 'stiffness': spring_stiffness,
+              'actuation': spring_actuation}
+    tables = {name: field.to_numpy() for name, field in tables.items()}
+    robots = [{'n_objects': int(counts[b]), 'n_springs': int(spring_counts[b]),
+               'head_id': int(heads[b]),
+               'halfsize': halfsizes[b, :counts[b]].tolist(),
+               'springs': {name: table[b, :spring_counts[b]].tolist()
+                           for name, table in tables.items()}}
+              for b in range(batch_size)]
+    return {'dt': dt, 'steps': steps, 'record_interval': record_interval,
+            'frame_dt': dt * record_interval, 'robot_id': robot_id,
+            'precision': precision, 'spring_solver': spring_solver,
+            'use_toi': use_toi, 'batch_size': batch_size, 'robots': robots}
+
+
+def open_trajectory(directory, total_steps):
+    """A TrajectoryWriter for the recorded frames of a rollout of
+    `total_steps` steps, and the chunk buffers frames are copied through."""
+    assert trajectory_chunk <= record_capacity
+    real_type = np.float32 if real == ti.f32 else np.float64
+    shapes = {'x': (batch_size, n_objects, 2), 'v': (batch_size, n_objects, 2),
+              'rotation': (batch_size, n_objects),
+              'omega': (batch_size, n_objects),
+              'actuation': (batch_size, n_springs)}
+    writer = TrajectoryWriter(directory, (total_steps - 1) // record_interval + 1,
+                              shapes, real_type, trajectory_metadata())
+    buffers = {name: np.zeros((trajectory_chunk, *shape), real_type)
+               for name, shape in shapes.items()}
+    return writer, buffers
+
+
+def flush_trajectory(writer, buffers, recorded, final=False):
+    """Moves the frames recorded since the last flush, up to `recorded`,
+    into the writer in whole chunks; with `final` the rest as well."""
+    while recorded - writer.frames >= trajectory_chunk or \
+            (final and recorded > writer.frames):
+        n = min(trajectory_chunk, recorded - writer.frames)
+        copy_record_frames(writer.frames, n, *buffers.values())
+        writer.write(writer.frames,
+                     {name: buffer[:n] for name, buffer in buffers.items()})
 
 
-def forward(output=None, visualize=True):
+@ti.kernel
+def simulate_steps(t_begin: ti.i32, t_end: ti.i32, toi: ti.template(),
+                   metrics: ti.template()):
+    # Fused rollout: runs steps t_begin..t_end-1 in one launch. Robots are
+    # stepped in parallel, the time loop and the per-object / per-spring
+    # work run serially inside each robot's thread. With metrics on, the
+    # trajectory metrics are updated as each step is taken.
+    for b in range(batch_size):
+        n_items = ti.max(robot_n_objects[b], robot_n_springs[b])
+        for t in range(t_begin, t_end):
+            # Reverse-mode AD drops gradients of sibling loops nested in a
+            # serial loop, so the four phases of a step share one loop nest.
+            for phase in range(4):
+                for i in range(n_items):
+                    if phase == 0:
+                        if ti.static(reuse_slots):
+                            if i < robot_n_objects[b]:
+                                clear_increments(b, t, i)
+                        if ti.static(not fills_actuation()):
+                            if i < robot_n_springs[b]:
+                                open_loop_control(b, t - 1, i)
+                    elif phase == 1:
+                        if i < robot_n_objects[b]:
+                            collide_object(b, t - 1, i)
+                    elif phase == 2:
+                        if i < robot_n_springs[b]:
+                            spring_force(b, t - 1, i)
+                    else:
+                        if i < robot_n_objects[b]:
+                            advance_object(b, t, i, toi)
+                            if ti.static(metrics):
+                                track_object(b, t, i)
+                        if ti.static(metrics):
+                            if i == n_items - 1:
+                                finish_metrics_step(b, t)
+                        if ti.static(record_interval > 0):
+                            if t % record_interval == 0:
+                                record_item(b, t, i)
+
+
+# created on first use so processes that never draw (e.g. evaluation
+# workers) do not open a window
+gui = None
+
+
+def get_gui():
+    global gui
+    if gui is None:
+        gui = ti.GUI('Rigid Body Simulation', (512, 512),
+                     background_color=0xFFFFFF,
+                     show_gui=not headless)
+    return gui
+
+
+# box corners relative to the box center, in units of its half size
+box_corners = ((-1, -1), (1, -1), (1, 1), (-1, 1))
+
+
+@ti.ad.no_grad
+@ti.kernel
+def export_frame(b: ti.i32, t: ti.i32, corners: ti.types.ndarray(),
+                 spring_ends: ti.types.ndarray(), spring_act: ti.types.ndarray()):
+    # world space geometry of robot b at step t, for drawing
+    for i in range(robot_n_objects[b]):
+        rot_matrix = rotation_matrix(rotation[b, slot(t), i])
+        for k in ti.static(range(4)):
+            offset = ti.Vector(box_corners[k]) * halfsize[b, i]
+            p = x[b, slot(t), i] + rot_matrix @ offset
+            corners[i, k, 0] = p[0]
+            corners[i, k, 1] = p[1]
+    for i in range(robot_n_springs[b]):
+        pa, _, _ = to_world(b, t, spring_anchor_a[b, i], spring_offset_a[b, i])
+        pb, _, _ = to_world(b, t, spring_anchor_b[b, i], spring_offset_b[b, i])
+        for d in ti.static(range(2)):
+            spring_ends[i, 0, d] = pa[d]
+            spring_ends[i, 1, d] = pb[d]
+        spring_act[i] = actuation[b, slot(t - 1), i]
+
+
+def render_frame(t, output=None, writer=None):
+    gui = get_gui()
+    # only the first robot of the population is drawn
+    b = 0
+    n_boxes = robot_n_objects[b]
+    n_links = robot_n_springs[b]
+
+    corners = np.zeros((n_boxes, 4, 2), dtype=np.float32)
+    ends = np.zeros((n_links, 2, 2), dtype=np.float32)
+    act = np.zeros(n_links, dtype=np.float32)
+    export_frame(b, t, corners, ends, act)
+
+    bad = ~np.isfinite(ends).all(axis=(1, 2))
+    if bad.any():
+        print(f"Warning: NaN/Inf in spring positions at t={t}, "
+              f"springs={np.nonzero(bad)[0].tolist()}")
+        ends[bad] = 0.5  # Default safe position
+    structural = spring_length.to_numpy()[b, :n_links] == -1
+    actuated = (spring_actuation.to_numpy()[b, :n_links] != 0) & ~structural
+    a = act * 0.5
+    bad = actuated & (~np.isfinite(a) | (np.abs(a) > 1e3))
+    if bad.any():
+        print(f"Warning: Bad actuation at t={t}, "
+              f"springs={np.nonzero(bad)[0].tolist()}")
+        a[bad] = 0.0  # Set to safe value
+    a[~actuated] = 0.0
+
+    # box outlines: edge k runs from corner k to corner k + 1
+    gui.lines(corners.reshape(-1, 2),
+              np.roll(corners, -1, axis=1).reshape(-1, 2),
+              color=0x0,
+              radius=2)
+
+    # springs: a black outline under the actuation colored line, drawn
+    # wider for the structural links (spring_length == -1)
+    color = np.where(actuated, ti.rgb_to_hex((0.5 + a, 0.5 - np.abs(a), 0.5 - a)),
+                     0xFF2233)  # Default color
+    width = np.where(structural, 7, 5)
+    gui.lines(ends[:, 0], ends[:, 1], color=0x000000, radius=width + 2)
+    gui.lines(ends[:, 0], ends[:, 1], color=color, radius=width)
+
+    gui.line((0.05, ground_height - 5e-3),
+             (0.95, ground_height - 5e-3),
+             color=0x0,
+             radius=5)
+
+    file = None
+    if writer is not None:
+        writer.write(gui.get_image())
+    elif output:
+        file = f'rigid_body/{output}/{t:04d}.png'
+    gui.show(file=file)
+
+
+def forward(output=None, visualize=True, fused=None, total_steps=None,
+            trajectory=None):
+    """Runs a rollout and returns the robots the watchdog flagged in it.
+
+    With a `trajectory` directory, the recorded frames (every
+    record_interval steps) are streamed into .npy files there.
+    """
+    global rollout_steps
+    reset_initial_state()
     initialize_properties()
+    reset_watchdog()
+    reset_metrics()
+    accumulate_metrics(0)
 
     interval = vis_interval
-    total_steps = steps
+    if total_steps is None:
+        total_steps = steps
+        if output:
+            total_steps *= 2
+    # an output with a .gif/.mp4 extension is streamed into that file by a
+    # background encoder, anything else is a directory of PNG frames
+    writer = None
     if output:
         print(output)
         interval = output_vis_interval
-        os.makedirs('rigid_body/{}/'.format(output), exist_ok=True)
-        total_steps *= 2
+        if os.path.splitext(output)[1]:
+            writer = FrameWriter(output, fps=video_fps)
+        else:
+            os.makedirs('rigid_body/{}/'.format(output), exist_ok=True)
+    if not reuse_slots:
+        assert total_steps <= max_steps, 'use --forward_only for longer rollouts'
 
     goal[None] = [0.9, 0.15]
 
-    for t in range(1, total_steps):
-        apply_open_loop_control(t - 1)
-        
-        collide(t - 1)
-        apply_spring_force(t - 1)
-        if use_toi:
-            advance_toi(t)
+    if fused is None:
+        fused = use_fused
+    # the fused kernel has no box-box contacts
+    fused = fused and body_collision == 'none'
+
+    if record_interval > 0:
+        record_frame(0)
+    if trajectory:
+        if record_interval <= 0:
+            raise ValueError('trajectory export needs record_interval > 0')
+        trajectory_writer, trajectory_buffers = open_trajectory(trajectory,
+                                                                total_steps)
+
+    # steps before this one have their actuation in place
+    filled = 0
+    t = 1
+    while t < total_steps:
+        if fills_actuation() and t - 1 >= filled:
+            # as many steps as the state slots hold at a time
+            filled = min(t - 1 + state_slots - 1, total_steps - 1)
+            with profile_phase('control'):
+                fill_actuation(t - 1, filled)
+        if fused:
+            # run everything up to the next drawn frame (or the step the loss
+            # is taken at) in a single launch
+            t_end = total_steps
+            if visualize:
+                t_end = min(t_end, (t // interval + 1) * interval)
+            if t < steps:
+                t_end = min(t_end, steps)
+            if watchdog_interval > 0:
+                t_end = min(t_end, (t // watchdog_interval + 1) * watchdog_interval)
+            if fills_actuation():
+                t_end = min(t_end, filled + 1)
+            if trajectory:
+                # not more frames than the recording buffer holds unexported
+                t_end = min(t_end, (trajectory_writer.frames + record_capacity) *
+                            record_interval)
+            # the gradient of a taped launch would run the metric updates
+            # again, so they are only fused in when slots are reused (and the
+            # states they read are gone after the launch)
+            with profile_phase('fused_steps'):
+                simulate_steps(t, t_end, use_toi, reuse_slots)
+            if not reuse_slots:
+                with profile_phase('metrics'):
+                    accumulate_metrics_range(t, t_end)
+            t = t_end - 1
         else:
-            advance_no_toi(t)
-
+            if reuse_slots:
+                with profile_phase('clear_states'):
+                    clear_step(t)
+            if not fills_actuation():
+                with profile_phase('control'):
+                    apply_open_loop_control(t - 1)
+            with profile_phase('collide'):
+                collide(t - 1)
+                for kernel, args in body_collision_launches(t - 1):
+                    kernel(*args)
+            with profile_phase('springs'):
+                apply_spring_force(t - 1)
+            with profile_phase('integrate'):
+                if use_toi:
+                    advance_toi(t)
+                else:
+                    advance_no_toi(t)
+            with profile_phase('metrics'):
+                accumulate_metrics(t)
+            if record_interval > 0 and t % record_interval == 0:
+                with profile_phase('record'):
+                    record_frame(t)
+
+        if trajectory:
+            with profile_phase('record'):
+                flush_trajectory(trajectory_writer, trajectory_buffers,
+                                 t // record_interval + 1)
+
+        if cold_start is not None:
+            report_cold_start()
+
+        if watchdog_due(t + 1) and population_diverged(t):
+            # nothing left worth simulating
+            print('All robots diverged by step {}, stopping the rollout'.format(t))
+            if t < steps - 1:
+                loss[None] = math.nan
+            break
+
+        if t == steps - 1:
+            loss[None] = 0
+            compute_loss(t)
 
         if (t + 1) % interval == 0 and visualize:
+            with profile_phase('render'):
+                render_frame(t, output, writer)
+        t += 1
+
+    if writer is not None:
+        with profile_phase('render'):
+            writer.close()
+    if trajectory:
+        with profile_phase('record'):
+            flush_trajectory(trajectory_writer, trajectory_buffers,
+                             min(t, total_steps - 1) // record_interval + 1,
+                             final=True)
+            trajectory_writer.close()
+    rollout_steps = min(t, total_steps - 1)
+    if watchdog_interval > 0:
+        check_divergence(rollout_steps)
+    return rollout_failures()
 
-            for i in range(n_objects):
-                points = []
-                for k in range(4):
-                    offset_scale = [[-1, -1], [1, -1], [1, 1], [-1, 1]][k]
-                    rot = rotation[t, i]
-                    rot_matrix = np.array([[math.cos(rot), -math.sin(rot)],
-                                           [math.sin(rot),
-                                            math.cos(rot)]])
-
-                    pos = np.array([x[t, i][0], x[t, i][1]
-                                    ]) + offset_scale * rot_matrix @ np.array(
-                                        [halfsize[i][0], halfsize[i][1]])
-
-                    points.append((pos[0], pos[1]))
-
-                for k in range(4):
-                    gui.line(points[k],
-                             points[(k + 1) % 4],
-                             color=0x0,
-                             radius=2)
-
-            for i in range(n_springs):
-                def get_world_loc(i, offset):
-                    rot = rotation[t, i]
-                    rot_matrix = np.array([[math.cos(rot), -math.sin(rot)],
-                                        [math.sin(rot), math.cos(rot)]])
-                    pos = np.array([[x[t, i][0]], [x[t, i][1]]]) + rot_matrix @ np.array([[offset[0]], [offset[1]]])
-
-                    # Ensure position is within bounds
-                    if np.any(np.isnan(pos)) or np.any(np.isinf(pos)):
-                        print(f"Warning: NaN/Inf in position at t={t}, i={i}, offset={offset}")
-                        pos = np.array([[0.5], [0.5]])  # Default safe position
-
-                    return pos
-
-                pt1 = get_world_loc(spring_anchor_a[i], spring_offset_a[i])
-                pt2 = get_world_loc(spring_anchor_b[i], spring_offset_b[i])
-
-                color = 0xFF2233  # Default color
-
-                if spring_actuation[i] != 0 and spring_length[i] != -1:
-                    a = actuation[t - 1, i] * 0.5  
-                    if np.isnan(a) or np.isinf(a) or abs(a) > 1e3:  # Additional check for very large values
-                        print(f"Warning: Bad actuation at t={t}, i={i}, actuation={actuation[t-1, i]}")
-                        a = 0.0  # Set to safe value
-                    color = ti.rgb_to_hex((0.5 + a, 0.5 - abs(a), 0.5 - a))
-
-                if spring_length[i] == -1:
-                    gui.line(pt1, pt2, color=0x000000, radius=9)
-                    gui.line(pt1, pt2, color=color, radius=7)
-                else:
-                    gui.line(pt1, pt2, color=0x000000, radius=7)
-                    gui.line(pt1, pt2, color=color, radius=5)
 
-            gui.line((0.05, ground_height - 5e-3),
-                     (0.95, ground_height - 5e-3),
-                     color=0x0,
-                     radius=5)
+@ti.kernel
+def clear_states():
+    for b, t in ti.ndrange(batch_size, state_slots):
+        for i in range(0, n_objects):
+            clear_increments(b, t, i)
+
+@ti.kernel
+def save_checkpoint(k: ti.i32, t: ti.i32):
+    for b, i in ti.ndrange(batch_size, n_objects):
+        checkpoint_x[b, k, i] = x[b, slot(t), i]
+        checkpoint_v[b, k, i] = v[b, slot(t), i]
+        checkpoint_rotation[b, k, i] = rotation[b, slot(t), i]
+        checkpoint_omega[b, k, i] = omega[b, slot(t), i]
 
-            file = None
-            if output:
-                file = f'rigid_body/{output}/{t:04d}.png'
-            gui.show(file=file)
 
-    loss[None] = 0
-    compute_loss(steps - 1)
+@ti.kernel
+def load_checkpoint(k: ti.i32, t: ti.i32):
+    for b, i in ti.ndrange(batch_size, n_objects):
+        x[b, slot(t), i] = checkpoint_x[b, k, i]
+        v[b, slot(t), i] = checkpoint_v[b, k, i]
+        rotation[b, slot(t), i] = checkpoint_rotation[b, k, i]
+        omega[b, slot(t), i] = checkpoint_omega[b, k, i]
 
 
 @ti.kernel
-def clear_states():
-    for t in range(0, max_steps):
-        for i in range(0, n_objects):
-            v_inc[t, i] = ti.Vector([0.0, 0.0])
-            x_inc[t, i] = ti.Vector([0.0, 0.0])
-            rotation_inc[t, i] = 0.0
-            omega_inc[t, i] = 0.0
+def clear_segment_gradients(t_keep: ti.i32):
+    # Zeroes the gradients of one segment's state except at step t_keep, the
+    # boundary whose gradient is carried over from the following segment
+    for b, k, i in ti.ndrange(batch_size, state_slots, n_objects):
+        if k != slot(t_keep):
+            x.grad[b, k, i] = ti.Vector([0.0, 0.0])
+            v.grad[b, k, i] = ti.Vector([0.0, 0.0])
+            rotation.grad[b, k, i] = 0.0
+            omega.grad[b, k, i] = 0.0
+        x_inc.grad[b, k, i] = ti.Vector([0.0, 0.0])
+        v_inc.grad[b, k, i] = ti.Vector([0.0, 0.0])
+        rotation_inc.grad[b, k, i] = 0.0
+        omega_inc.grad[b, k, i] = 0.0
+    for b, k, i in ti.ndrange(batch_size, state_slots, n_springs):
+        actuation.grad[b, k, i] = 0.0
+    for b, k, i in ti.ndrange(batch_size, state_slots, n_hidden):
+        hidden.grad[b, k, i] = 0.0
+
+
+def simulate_segment(t_begin, t_end, fused, metrics=True):
+    """Runs steps t_begin..t_end-1 and returns the launched kernels in order.
+
+    Segments recomputed for the backward pass leave the metrics alone.
+    """
+    launches = []
+    if fills_actuation():
+        # a segment never spans more steps than there are state slots
+        fill_actuation(t_begin - 1, t_end - 1)
+        launches.append((fill_actuation, (t_begin - 1, t_end - 1)))
+    if fused:
+        simulate_steps(t_begin, t_end, use_toi, metrics)
+        return launches + [(simulate_steps, (t_begin, t_end, use_toi, metrics))]
+
+    advance = advance_toi if use_toi else advance_no_toi
+    for t in range(t_begin, t_end):
+        step = [(collide, (t - 1,))] + body_collision_launches(t - 1) + \
+            [(apply_spring_force, (t - 1,)), (advance, (t,))]
+        if not fills_actuation():
+            step.insert(0, (apply_open_loop_control, (t - 1,)))
+        for kernel, args in step:
+            kernel(*args)
+            launches.append((kernel, args))
+        if metrics:
+            accumulate_metrics(t)
+    return launches
+
+
+def forward_backward_checkpointed(fused=None):
+    """Computes the loss and its gradients like ti.ad.Tape around forward().
+
+    Only the state at every checkpoint_interval-th step is kept. The
+    backward pass walks the segments from last to first, recomputes each
+    one from its checkpoint and replays the gradient kernels, carrying the
+    gradient of the segment's first state into the previous segment.
+    """
+    if fused is None:
+        fused = use_fused
+    fused = fused and body_collision == 'none'
+    K = checkpoint_interval
+    segments = [(k * K, min(k * K + K, steps - 1)) for k in range(n_checkpoints())]
+
+    reset_initial_state()
+    initialize_properties()
+    reset_watchdog()
+    reset_metrics()
+    accumulate_metrics(0)
+    goal[None] = [0.9, 0.15]
+
+    # forward pass, keeping only the segment boundaries
+    for k, (t_begin, t_end) in enumerate(segments):
+        save_checkpoint(k, t_begin)
+        with profile_phase('clear_states'):
+            clear_states()
+        with profile_phase('forward'):
+            simulate_segment(t_begin + 1, t_end + 1, fused)
+        if watchdog_interval > 0 and population_diverged(t_end):
+            print('All robots diverged by step {}, skipping the backward pass'.format(t_end))
+            loss[None] = math.nan
+            return
+
+    with profile_phase('backward'):
+        ti.ad.clear_all_gradients()
+    for k in reversed(range(len(segments))):
+        t_begin, t_end = segments[k]
+        load_checkpoint(k, t_begin)
+        with profile_phase('clear_states'):
+            clear_states()
+        with profile_phase('recompute'):
+            if k < len(segments) - 1:
+                clear_segment_gradients(t_end)
+            launches = simulate_segment(t_begin + 1, t_end + 1, fused, False)
+            if k == len(segments) - 1:
+                loss[None] = 0
+                compute_loss(steps - 1)
+                launches.append((compute_loss, (steps - 1,)))
+                loss.grad[None] = 1
+        with profile_phase('backward'):
+            for kernel, args in reversed(launches):
+                kernel.grad(*args)
+    with profile_phase('backward'):
+        initialize_properties.grad()
+        reset_initial_state.grad()
+
 
 def fitness_function():
-    """Evaluates fitness as the maximum height reached by any object."""
-    max_height = max(x[steps - 1, i][1] for i in range(n_objects))
-    return max_height
+    """Evaluates fitness as the maximum height of any object at the loss step.
+
+    Read from the trajectory metrics of the last rollout. Returns one value
+    per robot in the population, NaN for empty slots and robots the
+    watchdog flagged.
+    """
+    heights = metric_final_height.to_numpy().astype(np.float64)
+    heights[robot_n_objects.to_numpy() == 0] = np.nan
+    heights[robot_failure.to_numpy() > 0] = np.nan
+    return heights
 
 def mutate_n_boxes(n_boxes, min_boxes=3, max_boxes=10):
     """Mutates the number of boxes with larger random steps."""
@@ -441,111 +1627,622 @@ def mutate_n_boxes(n_boxes, min_boxes=3, max_boxes=10):
     new_n_boxes = max(min_boxes, min(max_boxes, n_boxes + mutation_step))
     return new_n_boxes
 
-def evolutionary_optimization(generations=2, population_size=5, min_boxes=3, max_boxes=10):
-    """Optimizes geometry (number of boxes) using mutation-only evolutionary strategy."""
-    population = [random.randint(min_boxes, max_boxes) for _ in range(population_size)]
+def resize_cpg(cpg, n_springs):
+    """Fits pattern generator rows to a robot with n_springs springs, keeping
+    the leading rows and giving new springs the default pattern."""
+    resized = default_cpg(n_springs)
+    if cpg is not None:
+        kept = min(len(cpg), n_springs)
+        resized[:kept] = cpg[:kept]
+    return resized
+
+
+def mutate_cpg(cpg, n_springs, rng, scale=0.1):
+    """Perturbs every spring's frequency, amplitude and phase."""
+    cpg = resize_cpg(cpg, n_springs)
+    noise = rng.normal(0.0, scale, cpg.shape)
+    cpg[:, 0] *= np.exp(noise[:, 0])
+    cpg[:, 1] = np.clip(cpg[:, 1] + noise[:, 1], 0.0, 1.0)
+    cpg[:, 2] = (cpg[:, 2] + 2 * math.pi * noise[:, 2]) % (2 * math.pi)
+    return cpg
+
+
+def genome_key(n_boxes, seed, cpg=None, robot=None):
+    """Hash of a candidate's robot and every setting its fitness depends on.
+
+    `robot` is the candidate's Genome when it has already been built.
+    """
+    robot = robot or robot_config.to_genome(robots[robot_id], n_boxes)
+    objects, springs = robot.tables()
+    h_id = robot.head_id
+    cpg = resize_cpg(cpg, len(springs))
+    return genome_hash(objects, springs, head_id=h_id, seed=seed, cpg=cpg, dt=dt,
+                       steps=steps, toi=True, default_actuation=default_actuation,
+                       elasticity=elasticity, ground_height=ground_height,
+                       gravity=gravity, friction=friction, penalty=penalty,
+                       damping=damping, body_collision=body_collision,
+                       max_contacts=max_contacts,
+                       spring_solver=spring_solver, precision=precision,
+                       # flagged robots score NaN
+                       watchdog_interval=watchdog_interval, max_speed=max_speed)
+
+
+def candidate_seed(key):
+    """Deterministic per-candidate seed, equal for equal genome keys."""
+    return int(key[:8], 16)
+
+
+def evaluate_genome(genome, on_iteration=None, capacity=None):
+    """Simulates and optimizes one candidate, returns (fitness, losses).
+
+    A genome is the compact tuple (n_boxes, seed, cpg) sent to worker
+    processes, `cpg` None for the default pattern generators. With a
+    `capacity` shared by all candidates the fields, and so the compiled
+    kernels, are reused from one candidate to the next.
+    """
+    n_boxes, seed, cpg = genome
+    random.seed(seed)
+    np.random.seed(seed)
+    setup_population([robots[robot_id](n_boxes)], capacity, cpgs=[cpg])
+    losses = optimize(toi=True, visualize=False, on_iteration=on_iteration)
+    return float(fitness_function()[0]), losses
+
+
+def evaluation_worker(worker_id, tasks, results, n_threads, settings,
+                      capacity=None):
+    # Each worker owns its own Taichi runtime and robot fields. Spawned
+    # workers import this module without running main(), so the command
+    # line settings are passed in.
+    globals().update(settings)
+    init_taichi(cpu_max_num_threads=n_threads)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        cid, genome = task
+
+        def on_iteration(iteration, iter_loss):
+            results.send(('loss', worker_id, cid, iteration, iter_loss))
+
+        try:
+            fitness, _ = evaluate_genome(genome, on_iteration, capacity)
+            results.send(('done', worker_id, cid, fitness))
+        except Exception as e:
+            results.send(('error', worker_id, cid, repr(e)))
+
+
+class WorkerPool:
+    """Evaluates genomes in parallel, one Taichi runtime per worker process.
+
+    Loss histories stream back while candidates run. A candidate that takes
+    longer than `timeout` seconds (including kernel compilation) has its
+    worker killed and replaced. Every worker sends its results through a
+    pipe of its own, which is thrown away with it: a process killed in
+    the middle of a write cannot corrupt or lock the other workers'
+    channel.
+    """
+
+    def __init__(self, n_workers, timeout=None, capacity=None):
+        self.ctx = multiprocessing.get_context('spawn')
+        self.timeout = timeout
+        self.capacity = capacity
+        self.n_threads = max(1, multiprocessing.cpu_count() // n_workers)
+        self.settings = {name: globals()[name] for name in cli_settings}
+        self.workers = [self._start_worker(i) for i in range(n_workers)]
+
+    def _start_worker(self, worker_id):
+        tasks = self.ctx.Queue()
+        results, sender = self.ctx.Pipe(duplex=False)
+        process = self.ctx.Process(target=evaluation_worker,
+                                   args=(worker_id, tasks, sender,
+                                         self.n_threads, self.settings,
+                                         self.capacity),
+                                   daemon=True)
+        process.start()
+        # only the worker writes, so reading hits EOF once it is gone
+        sender.close()
+        return {'process': process, 'tasks': tasks, 'results': results,
+                'task': None, 'deadline': None}
+
+    def _restart_worker(self, worker_id):
+        w = self.workers[worker_id]
+        w['process'].kill()
+        w['process'].join()
+        w['results'].close()
+        w['tasks'].cancel_join_thread()
+        self.workers[worker_id] = self._start_worker(worker_id)
+
+    def evaluate(self, genomes):
+        """Returns (fitness, loss_histories), one entry per genome.
+
+        Candidates that raised or timed out have None for their fitness, as
+        opposed to NaN for a finished rollout the watchdog flagged.
+        """
+        pending = list(enumerate(genomes))
+        fitness = [None] * len(genomes)
+        histories = [[] for _ in genomes]
+
+        while pending or any(w['task'] is not None for w in self.workers):
+            for w in self.workers:
+                if w['task'] is None and pending:
+                    cid, genome = pending.pop(0)
+                    w['tasks'].put((cid, genome))
+                    w['task'] = cid
+                    if self.timeout:
+                        w['deadline'] = time.monotonic() + self.timeout
+
+            ready = multiprocessing.connection.wait(
+                [w['results'] for w in self.workers], timeout=0.1)
+            for worker_id, w in enumerate(self.workers):
+                if w['results'] not in ready:
+                    continue
+                try:
+                    kind, _, cid, *payload = w['results'].recv()
+                except EOFError:
+                    # the worker died; its candidate, if any, has no result
+                    print(f'Worker {worker_id} exited, restarting it')
+                    self._restart_worker(worker_id)
+                    continue
+                if w['task'] == cid:
+                    if kind == 'loss':
+                        iteration, iter_loss = payload
+                        histories[cid].append(iter_loss)
+                        print(f'Candidate {cid} {genomes[cid][:2]}: '
+                              f'Iter={iteration}, Loss={iter_loss:.6f}')
+                    else:
+                        if kind == 'done':
+                            fitness[cid] = payload[0]
+                        else:
+                            print(f'Error with candidate {cid} {genomes[cid][:2]}: {payload[0]}')
+                        w['task'] = None
+
+            for worker_id, w in enumerate(self.workers):
+                if w['task'] is not None and w['deadline'] is not None \
+                        and time.monotonic() > w['deadline']:
+                    print(f"Candidate {w['task']} {genomes[w['task']][:2]} timed out, "
+                          f"restarting worker {worker_id}")
+                    self._restart_worker(worker_id)
+
+        return fitness, histories
+
+    def close(self):
+        for w in self.workers:
+            w['tasks'].put(None)
+        for w in self.workers:
+            w['process'].join(timeout=10)
+            if w['process'].is_alive():
+                w['process'].kill()
+
+
+def save_snapshot(path, state, arrays):
+    """Replaces `path` with an .npz of the JSON `state` and the named arrays.
+
+    The file is written and flushed under a temporary name next to `path`
+    and then renamed over it, so a crash leaves either the previous snapshot
+    or the new one, never a partial file.
+    """
+    temporary = path + '.tmp'
+    try:
+        with open(temporary, 'wb') as f:
+            np.savez(f, state=np.array(json.dumps(state)), **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        # open() itself may have failed, leaving nothing to remove
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temporary)
+        raise
+
+
+def load_snapshot(path):
+    """Returns the (state, arrays) saved by save_snapshot."""
+    with np.load(path) as data:
+        state = json.loads(str(data['state']))
+        arrays = {name: data[name] for name in data.files if name != 'state'}
+    return state, arrays
+
+
+def evolutionary_optimization(generations=2, population_size=5, min_boxes=3, max_boxes=10,
+                              workers=0, timeout=None, seed=0, cache_path=None,
+                              cache_size=10000, snapshot_path=None, resume=False):
+    """Optimizes geometry (number of boxes) and the springs' pattern generators
+    using mutation-only evolutionary strategy.
+
+    Candidates are (n_boxes, cpg) pairs, `cpg` None for the default pattern
+    generators (the whole first generation). Each generation is simulated as one batch, so the whole population is
+    stepped by the same kernel launches. With `workers` > 0 the candidates
+    are instead evaluated one by one in a pool of worker processes, each
+    candidate seeded deterministically from `seed`. Duplicate candidates are
+    simulated once, and with `cache_path` fitness values persist across runs
+    in a FitnessCache. Returns the best (n_boxes, fitness, cpg).
+
+    With `snapshot_path` the next population, the best candidate, the
+    per-generation history and both random streams are saved there after
+    every generation; `resume` continues from that file up to `generations`
+    without evaluating the finished generations again.
+    """
+    random.seed(seed)
+    # pattern generators mutate from their own stream so the box counts
+    # drawn from `random` do not depend on them
+    cpg_rng = np.random.default_rng(seed)
+    population = [(random.randint(min_boxes, max_boxes), None)
+                  for _ in range(population_size)]
     best_solution = None
+    best_n_boxes = None
+    best_cpg = None
     best_fitness = -float('inf')
-
-    for gen in range(generations):
-        results = []
-
-        for n_boxes in population:
-            objects, springs, head_id = robots[robot_id](n_boxes)  # Use fixed spring structure
+    history = []
+    first_generation = 0
+
+    def save(next_generation):
+        state = {'generation': next_generation, 'seed': seed,
+                 'robot_id': robot_id, 'population_size': population_size,
+                 'n_boxes': [n for n, _ in population],
+                 'best_n_boxes': best_n_boxes, 'best_fitness': best_fitness,
+                 'history': history, 'random': random.getstate(),
+                 'cpg_rng': cpg_rng.bit_generator.state}
+        arrays = {f'cpg_{i}': cpg for i, (_, cpg) in enumerate(population)
+                  if cpg is not None}
+        if best_cpg is not None:
+            arrays['best_cpg'] = best_cpg
+        save_snapshot(snapshot_path, state, arrays)
+
+    if resume:
+        state, arrays = load_snapshot(snapshot_path)
+        for setting, value in (('seed', seed), ('robot_id', robot_id),
+                               ('population_size', population_size)):
+            if state[setting] != value:
+                raise ValueError(f'{snapshot_path} was saved with {setting}='
+                                 f'{state[setting]}, not {value}')
+        first_generation = state['generation']
+        population = [(n, arrays.get(f'cpg_{i}'))
+                      for i, n in enumerate(state['n_boxes'])]
+        best_n_boxes = state['best_n_boxes']
+        best_fitness = state['best_fitness']
+        best_cpg = arrays.get('best_cpg')
+        history = state['history']
+        version, internal, gauss = state['random']
+        random.setstate((version, tuple(internal), gauss))
+        cpg_rng.bit_generator.state = state['cpg_rng']
+        print(f'Resuming from generation {first_generation} of {snapshot_path}')
+
+    # a robot depends only on its box count, so each is built once per run
+    # and shared by the hash, the setup and the mutation
+    build = functools.lru_cache(maxsize=None)(
+        lambda n_boxes: robot_config.to_genome(robots[robot_id], n_boxes))
+
+    # Size the fields for the largest robot the mutation can produce
+    largest = build(max_boxes)
+    capacity = (len(largest.objects), len(largest.springs))
+
+    pool = WorkerPool(workers, timeout, capacity) if workers > 0 else None
+    cache = FitnessCache(cache_path, cache_size) if cache_path else None
+    try:
+        for gen in range(first_generation, generations):
+            results = []
+            fitness = []
 
             try:
-                setup_robot(objects, springs, head_id)
-                optimize(toi=True, visualize=False)
-                fitness = fitness_function()
-
-                if not np.isnan(fitness) and fitness > 0:
-                    results.append((fitness, n_boxes))
-                else:
-                    print(f"Skipping invalid result for n_boxes={n_boxes}, fitness={fitness}")
+                keys = [genome_key(n_boxes, seed, cpg, build(n_boxes))
+                        for n_boxes, cpg in population]
+                known = {}
+                if cache is not None:
+                    for key in set(keys):
+                        f = cache.get(key)
+                        if f is not None:
+                            known[key] = f
+                todo = list({key: candidate for key, candidate in zip(keys, population)
+                             if key not in known}.items())
+
+                new_fitness = []
+                if todo and pool:
+                    # the workers are not profiled, only waited for
+                    with profile_phase('workers'):
+                        new_fitness, _ = pool.evaluate([
+                            (n_boxes, candidate_seed(key), cpg)
+                            for key, (n_boxes, cpg) in todo
+                        ])
+                elif todo:
+                    with profile_phase('setup'):
+                        setup_population([build(n_boxes) for _, (n_boxes, _) in todo],
+                                         capacity, batch=population_size,  # Use fixed spring structure
+                                         cpgs=[cpg for _, (_, cpg) in todo])
+                    optimize(toi=True, visualize=False)
+                    new_fitness = fitness_function()
+                for (key, _), f in zip(todo, new_fitness):
+                    if f is None:
+                        # errors and timeouts say nothing about the genome,
+                        # so they are retried rather than cached
+                        known[key] = math.nan
+                        continue
+                    known[key] = f
+                    if cache is not None:
+                        cache.put(key, f)
+                fitness = [known[key] for key in keys]
+
+                if cache is not None:
+                    print(f'Generation {gen}: fitness cache {cache.hits} hits, '
+                          f'{cache.misses} misses')
+                    cache.reset_stats()
+
+                for (n_boxes, cpg), f in zip(population, fitness):
+                    if not np.isnan(f) and f > 0:
+                        results.append((f, n_boxes, cpg))
+                    else:
+                        print(f"Skipping invalid result for n_boxes={n_boxes}, fitness={f}")
 
             except Exception as e:
-                print(f"Error with n_boxes={n_boxes}: {e}")
-
-        if not results:
-            print("No valid results, using last best solution.")
-            continue
-
-        results.sort(reverse=True, key=lambda x: x[0])  # Keep highest fitness
-        best_fitness, best_n_boxes = results[0]
-
-        print(f'Generation {gen}: Best n_boxes={best_n_boxes}, Max Height={best_fitness:.3f}')
-
-        # Mutate best solution for next generation
-        population = [mutate_n_boxes(best_n_boxes) for _ in range(population_size)]
+                print(f"Error with population={population}: {e}")
+
+            if not results:
+                print("No valid results, using last best solution.")
+            else:
+                results.sort(reverse=True, key=lambda x: x[0])  # Keep highest fitness
+                best_fitness, best_n_boxes, best_cpg = results[0]
+
+                print(f'Generation {gen}: Best n_boxes={best_n_boxes}, Max Height={best_fitness:.3f}')
+
+                # Mutate best solution for next generation
+                population = []
+                for _ in range(population_size):
+                    n_boxes = mutate_n_boxes(best_n_boxes)
+                    n_springs = len(build(n_boxes).springs)
+                    population.append((n_boxes, mutate_cpg(best_cpg, n_springs, cpg_rng)))
+
+            history.append({'generation': gen, 'fitness': [float(f) for f in fitness],
+                            'best_n_boxes': best_n_boxes, 'best_fitness': best_fitness})
+            if snapshot_path:
+                with profile_phase('snapshot'):
+                    save(gen + 1)
+    finally:
+        if pool:
+            pool.close()
+        if cache is not None:
+            cache.close()
 
     print(f'Best solution: n_boxes={best_n_boxes}, Max Height={best_fitness:.3f}')
-    return best_n_boxes, best_fitness
-
-
-
-# Global flag to track allocation status
-fields_allocated = False  
+    if not pool:
+        print_allocation_stats()
+    return best_n_boxes, best_fitness, best_cpg
 
-def setup_robot(objects, springs, h_id):
-    global head_id, n_objects, n_springs, fields_allocated
-    head_id = h_id
-    n_objects = len(objects)
-    n_springs = len(springs)
 
-    # Prevent reallocation if fields are already allocated
-    if fields_allocated:
-        return  
 
-    allocate_fields()  # Now it's safe to allocate fields
-    fields_allocated = True  # Set the flag to prevent reallocation
+def robot_tables(objects, springs):
+    """Converts a robot's object and spring lists to array tables.
 
-    print('n_objects=', n_objects, '   n_springs=', n_springs)
+    Objects become rows (x, y, half_x, half_y, rotation) and springs rows
+    (a, b, offset_a_x, offset_a_y, offset_b_x, offset_b_y, length, stiffness,
+    actuation). Arrays already in this layout are returned unchanged, and
+    the structured arrays of a robot_config.Genome are flattened to it.
+    """
+    if isinstance(objects, np.ndarray) and objects.dtype.names:
+        return robot_config.Genome(objects, springs, 0).tables()
+    if not isinstance(objects, np.ndarray):
+        objects = np.array([(*o[0], *o[1], o[2]) for o in objects],
+                           dtype=np.float64).reshape(-1, 5)
+    if not isinstance(springs, np.ndarray):
+        springs = np.array([(s[0], s[1], *s[2], *s[3], s[4], s[5], s[6])
+                            for s in springs],
+                           dtype=np.float64).reshape(-1, 9)
+    return objects, springs
 
-    for i in range(n_objects):
-        x[0, i] = objects[i][0]
-        halfsize[i] = objects[i][1]
-        rotation[0, i] = objects[i][2]
 
-    for i in range(n_springs):
-        s = springs[i]
-        spring_anchor_a[i] = s[0]
-        spring_anchor_b[i] = s[1]
-        spring_offset_a[i] = s[2]
-        spring_offset_b[i] = s[3]
-        spring_length[i] = s[4]
-        spring_stiffness[i] = s[5]
-        spring_actuation[i] = s[6] if s[6] else default_actuation
-
-
-
-import matplotlib.pyplot as plt
-
-def optimize(toi=True, visualize=True):
+@ti.kernel
+def load_initial_state(objects: ti.types.ndarray()):
+    for b, i in ti.ndrange(batch_size, n_objects):
+        initial_x[b, i] = ti.Vector([objects[b, i, 0], objects[b, i, 1]])
+        initial_v[b, i] = ti.Vector([0.0, 0.0])
+        initial_rotation[b, i] = objects[b, i, 4]
+        initial_omega[b, i] = 0.0
+    restore_initial_state()
+
+
+def setup_population(population, capacity=None, batch=None, cpgs=None):
+    """Writes a population of robots into the batched fields.
+
+    `population` is a list of (objects, springs, head_id) tuples (or
+    robot_config.Genome) and `cpgs`
+    an optional list with one (n_springs, 3) array of pattern generator
+    rows per robot, `default_cpg` for robots without one. The fields
+    are sized for the bucket of `batch` (default `len(population)`) robots
+    and the largest box / spring count (or `capacity=(n_objects, n_springs)`
+    if larger), rounded up to powers of two. Smaller robots are padded and
+    masked out by their counts; batch slots past the population stay empty.
+    """
+    global batch_size, n_objects, n_springs, field_tree, field_bucket, \
+        field_tree_layout
+    max_objects = max(len(objects) for objects, _, _ in population)
+    max_springs = max(len(springs) for _, springs, _ in population)
+    if capacity:
+        max_objects = max(max_objects, capacity[0])
+        max_springs = max(max_springs, capacity[1])
+    bucket = (max(batch or 0, len(population)), capacity_bucket(max_objects),
+              capacity_bucket(max_springs))
+
+    layout = field_layout()
+    if bucket == field_bucket and layout == field_tree_layout:
+        allocation_stats['hits'] += 1
+    else:
+        allocation_stats['misses'] += 1
+        if field_tree is not None:
+            start = time.perf_counter()
+            field_tree.destroy()
+            allocation_stats['free_time'] += time.perf_counter() - start
+
+        batch_size, n_objects, n_springs = bucket
+        start = time.perf_counter()
+        field_tree = allocate_fields()
+        allocation_stats['alloc_time'] += time.perf_counter() - start
+        field_bucket = bucket
+        field_tree_layout = layout
+
+        print('batch_size=', batch_size, '   n_objects=', n_objects,
+              '   n_springs=', n_springs)
+
+    # one padded table per kind of element, uploaded in a single transfer
+    # each; unused batch slots simulate an empty robot
+    object_tables = np.zeros((batch_size, n_objects, 5))
+    spring_tables = np.zeros((batch_size, n_springs, 9))
+    cpg_tables = np.zeros((batch_size, n_springs, 3))
+    counts = np.zeros((2, batch_size), dtype=np.int32)
+    head_ids = np.zeros(batch_size, dtype=np.int32)
+    incident_starts = np.zeros((batch_size, n_objects + 1), dtype=np.int32)
+    incident_springs = np.zeros((batch_size, 2 * n_springs), dtype=np.int32)
+    for b, (objects, springs, h_id) in enumerate(population):
+        objects, springs = robot_tables(objects, springs)
+        object_tables[b, :len(objects)] = objects
+        spring_tables[b, :len(springs)] = springs
+        cpg_tables[b, :len(springs)] = resize_cpg(cpgs and cpgs[b], len(springs))
+        counts[:, b] = len(objects), len(springs)
+        head_ids[b] = h_id
+
+        # incidence index: both ends of every spring, grouped by object
+        owners = springs[:, :2].astype(np.int32).ravel()
+        order = np.argsort(owners, kind='stable')
+        incident_springs[b, :len(owners)] = np.arange(len(owners))[order]
+        incident_starts[b, 1:] = np.cumsum(
+            np.bincount(owners, minlength=n_objects))
+
+    real_type = np.float32 if real == ti.f32 else np.float64
+    object_tables = object_tables.astype(real_type)
+    spring_tables = spring_tables.astype(real_type)
+    robot_n_objects.from_numpy(counts[0])
+    robot_n_springs.from_numpy(counts[1])
+    robot_head_id.from_numpy(head_ids)
+    incident_start.from_numpy(incident_starts)
+    incident_spring.from_numpy(incident_springs)
+    if body_collision != 'none':
+        links = np.zeros((batch_size, n_objects, n_objects), dtype=np.int8)
+        for b in range(batch_size):
+            a, c = spring_tables[b, :counts[1, b], :2].astype(np.int32).T
+            links[b, a, c] = links[b, c, a] = 1
+        linked.from_numpy(links)
+    load_initial_state(object_tables)
+    halfsize.from_numpy(object_tables[:, :, 2:4])
+    spring_anchor_a.from_numpy(spring_tables[:, :, 0].astype(np.int32))
+    spring_anchor_b.from_numpy(spring_tables[:, :, 1].astype(np.int32))
+    spring_offset_a.from_numpy(spring_tables[:, :, 2:4])
+    spring_offset_b.from_numpy(spring_tables[:, :, 4:6])
+    spring_length.from_numpy(spring_tables[:, :, 6])
+    spring_stiffness.from_numpy(spring_tables[:, :, 7])
+    cpg_tables = cpg_tables.astype(real_type)
+    spring_frequency.from_numpy(cpg_tables[:, :, 0])
+    spring_amplitude.from_numpy(cpg_tables[:, :, 1])
+    spring_phase.from_numpy(cpg_tables[:, :, 2])
+    act = spring_tables[:, :, 8]
+    spring_actuation.from_numpy(np.where(act != 0, act, real_type(default_actuation)))
+
+
+def load_weights(w1, b1=None, w2=None, b2=None):
+    """Uploads the controller weights of the whole batch, one transfer each.
+
+    Arrays are broadcast to the field shapes, so a single robot's matrices
+    can be given for all of them. Missing arrays are set to zero.
+    """
+    real_type = np.float32 if real == ti.f32 else np.float64
+    for field, value in ((weights1, w1), (bias1, b1), (weights2, w2),
+                         (bias2, b2)):
+        value = 0 if value is None else value
+        field.from_numpy(
+            np.ascontiguousarray(np.broadcast_to(value, field.shape),
+                                 dtype=real_type))
+
+
+def print_allocation_stats():
+    s = allocation_stats
+    total = s['hits'] + s['misses']
+    hit_rate = s['hits'] / total if total else 0.0
+    print(f"Field trees: {s['misses']} allocated, {s['hits']} reused "
+          f"(hit rate {hit_rate:.0%}), allocation {s['alloc_time'] * 1e3:.1f} ms, "
+          f"free {s['free_time'] * 1e3:.1f} ms")
+
+
+def setup_robot(objects, springs, h_id, cpg=None):
+    setup_population([(objects, springs, h_id)], cpgs=[cpg])
+
+
+def optimize(toi=True, visualize=True, fused=None, on_iteration=None,
+             iterations=20):
+    """Runs `iterations` taped iterations and returns their losses.
+
+    `on_iteration(iter, loss)` is called after each iteration instead of
+    printing the loss. Stops early once the watchdog has flagged every
+    robot of the population.
+    """
     global use_toi
+    if forward_only:
+        raise RuntimeError('optimize needs gradients, run without --forward_only')
     use_toi = toi
 
     losses = []
-    for iter in range(20):
-        clear_states()
+    for iter in range(iterations):
+        if checkpoint_interval > 0:
+            forward_backward_checkpointed(fused=fused)
+        else:
+            with profile_phase('clear_states'):
+                clear_states()
 
-        with ti.ad.Tape(loss):
-            forward(visualize=visualize)
+            with profile_phase('backward'):
+                with ti.ad.Tape(loss):
+                    with profile_phase('forward'):
+                        forward(visualize=visualize, fused=fused)
 
         iter_loss = loss[None]  
         losses.append(iter_loss) 
 
-        print(f'Iter={iter}, Loss={iter_loss:.6f}')
+        if on_iteration is None:
+            print(f'Iter={iter}, Loss={iter_loss:.6f}')
+        else:
+            on_iteration(iter, iter_loss)
+
+        active = robot_n_objects.to_numpy() > 0
+        if watchdog_interval > 0 and np.all(robot_failure.to_numpy()[active] > 0):
+            break
 
     return losses  
 
 
 robot_id = 0
-robot_id = int(sys.argv[1])
-cmd = sys.argv[2]
-print(robot_id, cmd)
-
-def wheel_pattern_robot(n_boxes):
-    """Creates a wheel-like pattern using multiple boxes and springs."""
+n_boxes = 4
+
+# Rim connectivity of wheel_pattern_robot: 'full' links every pair of rim
+# boxes (O(n_boxes^2) springs), 'ring' each box to its two neighbours, 'knn'
+# each box to its wheel_neighbors nearest boxes and 'random' each box to
+# wheel_neighbors random ones. A spring_budget > 0 caps the total number of
+# springs by dropping the longest rim springs; the spokes are always kept.
+wheel_topology = 'full'
+wheel_neighbors = 2
+spring_budget = 0
+
+
+def rim_pairs(positions, topology, k, rng):
+    """Returns the sorted (i, j), i < j, pairs of rim boxes to connect."""
+    n = len(positions)
+    if topology == 'full':
+        pairs = [(i, j) for i in range(n) for j in range(i + 1, n)]
+    elif topology == 'ring':
+        pairs = [(i, (i + 1) % n) for i in range(n)]
+    elif topology == 'knn':
+        distance = np.linalg.norm(positions[:, None] - positions[None], axis=2)
+        np.fill_diagonal(distance, np.inf)
+        pairs = [(i, j) for i in range(n)
+                 for j in np.argsort(distance[i], kind='stable')[:k]]
+    elif topology == 'random':
+        pairs = [(i, j) for i in range(n)
+                 for j in rng.choice([j for j in range(n) if j != i],
+                                     size=min(k, n - 1), replace=False)]
+    else:
+        raise ValueError(f'Unknown wheel topology {topology!r}')
+    return sorted({(int(min(i, j)), int(max(i, j))) for i, j in pairs if i != j})
+
+
+def wheel_pattern_robot(n_boxes, topology=None, neighbors=None, budget=None):
+    """Creates a wheel-like pattern using multiple boxes and springs.
+
+    The rim connectivity defaults to wheel_topology, wheel_neighbors and
+    spring_budget.
+    """
     
     # n_boxes = 4  # Number of boxes forming the wheel
     radius = 0.2  # Distance from center to each box
@@ -569,10 +2266,19 @@ def wheel_pattern_robot(n_boxes):
         springs.append((i, center_id, (0, 0), (0, 0), radius, 100.0, 0.05))
 
     # Connect outer boxes to each other
-    for i in range(len(objects)):
-        for j in range(i + 1, len(objects)):
-            if i != center_id and j != center_id:
-                springs.append((i, j, (0, 0), (0, 0), radius, 800.0, 0.2))
+    topology = topology or wheel_topology
+    neighbors = neighbors or wheel_neighbors
+    budget = spring_budget if budget is None else budget
+    positions = np.array([o[0] for o in objects[:n_boxes]])
+    # seeded by the size so a genome always maps to the same robot
+    pairs = rim_pairs(positions, topology, neighbors,
+                      np.random.default_rng(n_boxes))
+    if budget > 0 and len(springs) + len(pairs) > budget:
+        length = [np.linalg.norm(positions[i] - positions[j]) for i, j in pairs]
+        keep = np.argsort(length, kind='stable')[:max(budget - len(springs), 0)]
+        pairs = [pairs[m] for m in sorted(keep)]
+    for i, j in pairs:
+        springs.append((i, j, (0, 0), (0, 0), radius, 800.0, 0.2))
 
     return objects, springs, center_id  # Return the object list, spring list, and the hub index
 
@@ -582,42 +2288,596 @@ robots = {
     0: wheel_pattern_robot,  # Add the wheel pattern as robot ID 0
 }
 
-import argparse
-import sys
-import numpy as np
 
-# Argument parser setup
-parser = argparse.ArgumentParser()
-parser.add_argument('robot_id', type=int, help='[robot_id=0, 1, 2, ...]')
-parser.add_argument('cmd', type=str, help='train/plot')
-parser.add_argument('--n_boxes', type=int, default=4, help='Number of boxes forming the wheel')
-options = parser.parse_args()
+def benchmark_topologies(box_counts=(10, 50, 100, 200),
+                         topologies=('full', 'ring', 'knn', 'random')):
+    """Prints simulated steps per second and peak height per rim topology.
+
+    Each rollout runs once to compile the kernels for the field bucket and
+    is then timed on a second run. The peak is the highest the head got
+    during the rollout. Rollouts the watchdog stopped are rated by the
+    steps they ran and marked as diverged.
+    """
+    print(f'{"n_boxes":>8} {"topology":>9} {"springs":>8} {"steps/s":>9} '
+          f'{"peak":>7}')
+    for count in box_counts:
+        for topology in topologies:
+            objects, springs, h_id = wheel_pattern_robot(count, topology)
+            setup_robot(objects, springs, h_id)
+            clear_states()
+            forward(visualize=False)
+            clear_states()
+            start = time.perf_counter()
+            failures = forward(visualize=False)
+            ti.sync()
+            elapsed = time.perf_counter() - start
+            peak = rollout_metrics()[0].peak_height
+            note = f'  diverged after {rollout_steps} steps' if failures else ''
+            print(f'{count:>8} {topology:>9} {len(springs):>8} '
+                  f'{rollout_steps / elapsed:>9.0f} {peak:>7.3f}{note}')
+
+
+def benchmark_collisions(box_counts=(10, 100, 1000), repeats=200):
+    """Prints the per-step cost of the all-pairs and grid broad phases.
+
+    The scene is a jittered lattice of small unconnected boxes, simulated
+    forward-only. Both broad phases must report the same contacts.
+    """
+    global forward_only, body_collision
+    forward_only, body_collision = True, 'grid'
+    rng = np.random.default_rng(0)
+    print(f'{"n_boxes":>8} {"contacts":>9} {"naive ms":>9} {"grid ms":>8}')
+    for count in box_counts:
+        side = math.ceil(math.sqrt(count))
+        cells = np.stack(np.unravel_index(np.arange(count), (side, side)), 1)
+        centers = 0.1 + (cells + 0.5) / side * 0.8 + rng.uniform(
+            -0.2, 0.2, (count, 2)) / side
+        objects = [(c, (0.3 / side, 0.3 / side), rng.uniform(0, math.pi))
+                   for c in centers]
+        setup_robot(objects, [], 0)
+        initialize_properties()
+
+        timings, contacts = {}, {}
+        for name, launches in (('naive', [(find_contacts, (0, False))]),
+                               ('grid', [(build_grid, (0,)),
+                                         (find_contacts, (0, True))])):
+            for kernel, args in launches:
+                kernel(*args)
+            ti.sync()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                for kernel, args in launches:
+                    kernel(*args)
+            ti.sync()
+            timings[name] = (time.perf_counter() - start) / repeats * 1e3
+            found = contact_count.to_numpy()[0, 0]
+            partners = contact_object.to_numpy()[0, 0]
+            contacts[name] = sorted((i, j) for i in range(count)
+                                    for j in partners[i, :found[i]])
+        assert contacts['naive'] == contacts['grid']
+        print(f'{count:>8} {len(contacts["grid"]):>9} '
+              f'{timings["naive"]:>9.3f} {timings["grid"]:>8.3f}')
+
+
+def prewarm_kernels(box_counts, batch_sizes=(1,)):
+    """Compiles everything a rollout needs with the current settings, for
+    robots of each box count in populations of each batch size, so later
+    processes find the kernels in the offline cache.
+
+    Runs two iterations of what `evolve` runs (forward only with
+    --forward_only) and prints the compile time, the first iteration's
+    excess over the second, which is near zero for cached kernels.
+    """
+    print(f'{"n_boxes":>8} {"batch":>6} {"bucket":>16} {"compile":>8}')
+    for count in box_counts:
+        robot = robots[robot_id](count)
+        for batch in batch_sizes:
+            setup_population([robot], batch=batch)
+            timings = []
+            for _ in range(2):
+                start = time.perf_counter()
+                if forward_only:
+                    clear_states()
+                    forward(visualize=False)
+                else:
+                    optimize(visualize=False, iterations=1,
+                             on_iteration=lambda iteration, loss: None)
+                ti.sync()
+                timings.append(time.perf_counter() - start)
+            print(f'{count:>8} {batch:>6} {str(field_bucket):>16} '
+                  f'{timings[0] - timings[1]:>7.2f}s')
+
+
+def benchmark_controllers(box_counts=(5, 20, 100), repeats=100):
+    """Prints compile time and time per step of the neural network
+    controller, tiled (nn1, nn2) against unrolled (nn1_unrolled,
+    nn2_unrolled), for wheels of the given box counts.
+
+    Compile time is the first step's excess over a warm one, so Taichi's
+    offline cache must be off for it to mean anything.
+    """
+    global forward_only
+    forward_only = True
+    print(f'{"n_boxes":>8} {"objects":>8} {"tiled compile":>14} '
+          f'{"tiled ms":>9} {"unrolled compile":>17} {"unrolled ms":>12}')
+    for count in box_counts:
+        objects, springs, h_id = wheel_pattern_robot(count)
+        setup_robot(objects, springs, h_id)
+        initialize_properties()
+        goal[None] = [0.9, 0.15]
+        row = []
+        for layers in ((nn1, nn2), (nn1_unrolled, nn2_unrolled)):
+            timings = []
+            for calls in (1, repeats):
+                start = time.perf_counter()
+                for _ in range(calls):
+                    for layer in layers:
+                        layer(0)
+                ti.sync()
+                timings.append((time.perf_counter() - start) / calls)
+            row += [timings[0] - timings[1], timings[1] * 1e3]
+        print(f'{count:>8} {len(objects):>8} {row[0]:>13.2f}s {row[1]:>9.3f} '
+              f'{row[2]:>16.2f}s {row[3]:>12.3f}')
+
+
+def count_kernel_launches():
+    """Counts the launches of this module's kernels from now on.
+
+    Every kernel is replaced by a counting wrapper; gradient launches (the
+    Tape's replay) are not counted. Returns the dict of counts by name.
+    """
+    counts = {}
+
+    def counting(name, kernel):
+        @functools.wraps(kernel)
+        def wrapper(*args):
+            counts[name] = counts.get(name, 0) + 1
+            return kernel(*args)
+        return wrapper
+
+    for name, value in list(globals().items()):
+        if getattr(value, '_is_wrapped_kernel', False):
+            globals()[name] = counting(name, value)
+    return counts
+
+
+def benchmark_robot(name, count):
+    """Builds a robot_config robot by builder name, or a wheel of `count` boxes."""
+    if name == 'wheel':
+        return wheel_pattern_robot(count)
+    builders = {builder.__name__: builder for builder in robot_config.robots}
+    return builders[name]()
+
+
+def benchmark_case(case, repeats=3):
+    """Times one benchmark case in this process.
+
+    The first rollout compiles the kernels; compile time is its excess over
+    the median of the `repeats` rollouts timed after it. Rates count the
+    steps actually simulated, so a rollout the watchdog stopped early is
+    not reported as fast; such cases are marked `diverged`.
+    """
+    global use_toi
+    import resource
 
-robot_id = options.robot_id
-cmd = options.cmd
-n_boxes = options.n_boxes
+    use_toi = case['toi']
+    objects, springs, h_id = benchmark_robot(case['robot'], case['n_boxes'])
+    launches = count_kernel_launches()
+    setup_robot(objects, springs, h_id)
 
+    failures = []
+
+    def rollout():
+        nonlocal failures
+        clear_states()
+        start = time.perf_counter()
+        if case['taped']:
+            with ti.ad.Tape(loss):
+                failures = forward(visualize=False)
+        else:
+            failures = forward(visualize=False)
+        ti.sync()
+        return time.perf_counter() - start
+
+    first = rollout()
+    launches.clear()
+    timings = sorted(rollout() for _ in range(repeats))
+    elapsed = timings[len(timings) // 2]
+    return dict(case,
+                objects=len(objects),
+                springs=len(springs),
+                steps=rollout_steps,
+                diverged=bool(failures),
+                steps_per_s=rollout_steps / elapsed,
+                launches_per_s=sum(launches.values()) / sum(timings),
+                compile_s=max(first - elapsed, 0.0),
+                # ru_maxrss is in kB on Linux and in bytes on macOS
+                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+                (2**20 if sys.platform == 'darwin' else 2**10))
+
+
+def isolated_worker(function, case, settings, results):
+    globals().update(settings)
+    if 'threads' in case:
+        init_taichi(cpu_max_num_threads=case['threads'])
+    else:
+        init_taichi()
+    try:
+        results.send(function(case))
+    except Exception as e:
+        results.send(dict(case, error=repr(e)))
+
+
+def run_isolated(function, case, settings):
+    """Returns `function(case)` computed in a fresh spawned process with the
+    module `settings`, or the case with an 'error' entry if it raised or
+    the process died before returning.
+
+    Each call compiles its own kernels, so settings baked into them (such
+    as dt) can differ between calls, and peak memory is the case's own.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    results, sender = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=isolated_worker,
+                          args=(function, case, settings, sender))
+    process.start()
+    # only the child holds the sending end now, so its death ends recv()
+    sender.close()
+    try:
+        result = results.recv()
+    except EOFError:
+        result = None
+    process.join()
+    results.close()
+    if result is None:
+        return dict(case, error=f'worker exited with code {process.exitcode}')
+    return result
+
+
+def run_benchmarks(robot_names, box_counts, thread_counts, fused=False):
+    """Benchmarks every combination of robot, TOI, taped and thread count.
+
+    `box_counts` sizes the 'wheel' robot. Each case runs in a fresh process
+    so its compile time and peak memory are its own. Returns the report.
+    """
+    settings = {name: globals()[name] for name in cli_settings}
+    cases = []
+    for name in robot_names:
+        for count in (box_counts if name == 'wheel' else [0]):
+            for toi in (True, False):
+                for taped in (False, True):
+                    for threads in thread_counts:
+                        cases.append(dict(robot=name, n_boxes=count, toi=toi,
+                                          taped=taped, fused=fused,
+                                          threads=threads))
+
+    print(f'{"robot":>8} {"boxes":>5} {"toi":>3} {"mode":>7} {"threads":>7} '
+          f'{"steps/s":>9} {"launch/s":>9} {"compile":>8} {"rss MB":>7}')
+    results = []
+    for case in cases:
+        result = run_isolated(benchmark_case, case,
+                              dict(settings, forward_only=not case['taped'],
+                                   use_fused=case['fused']))
+        results.append(result)
+        mode = 'taped' if case['taped'] else 'forward'
+        if 'error' in result:
+            print(f'{case["robot"]:>8} {case["n_boxes"]:>5} {case["toi"]:>3d} '
+                  f'{mode:>7} {case["threads"]:>7} {result["error"]}')
+            continue
+        print(f'{case["robot"]:>8} {case["n_boxes"]:>5} {case["toi"]:>3d} '
+              f'{mode:>7} {case["threads"]:>7} {result["steps_per_s"]:>9.0f} '
+              f'{result["launches_per_s"]:>9.0f} {result["compile_s"]:>7.2f}s '
+              f'{result["peak_rss_mb"]:>7.0f}'
+              f'{"  diverged after %d steps" % result["steps"] if result["diverged"] else ""}')
+    return {'taichi': '.'.join(map(str, ti.__version__)), 'arch': arch,
+            'precision': precision, 'steps': steps, 'cases': results}
+
+
+def integration_case(case):
+    """Times one untaped rollout of the case's robot in this process and
+    returns its box positions every record_interval steps."""
+    objects, springs, h_id = benchmark_robot(case['robot'], case['n_boxes'])
+    setup_robot(objects, springs, h_id)
+    # the first rollout compiles the kernels; the timed one starts again
+    # from the setup state
+    clear_states()
+    forward(visualize=False)
+    clear_states()
+    start = time.perf_counter()
+    failures = forward(visualize=False)
+    ti.sync()
+    elapsed = time.perf_counter() - start
+    metrics = rollout_metrics()[0]
+    frames = (steps - 1) // record_interval + 1
+    return dict(case, steps=steps, wall_s=elapsed, diverged=bool(failures),
+                final_height=metrics.final_height,
+                peak_height=metrics.peak_height,
+                positions=record_x.to_numpy()[0, :frames, :len(objects)])
+
+
+def integration_report(robot_names, dts=(0.001, 0.002, 0.004, 0.008),
+                       sample_time=0.016, n_boxes=10):
+    """Compares both spring solvers at each dt against the explicit solver
+    at the smallest dt, over the same simulated duration.
+
+    Box positions are sampled every `sample_time` seconds, which every dt
+    must divide. `n_boxes` sizes the 'wheel' robot. Returns one row per
+    robot, solver and dt.
+    """
+    settings = {name: globals()[name] for name in cli_settings}
+    simulated = steps * dt
+    for step in dts:
+        if abs(sample_time / step - round(sample_time / step)) > 1e-6:
+            raise ValueError(f'dt {step} does not divide the {sample_time} s '
+                             'sampling interval')
+
+    print(f'{"robot":>8} {"solver":>8} {"dt":>6} {"steps":>5} {"wall s":>7} '
+          f'{"speedup":>7} {"rms err":>8} {"max err":>8} {"final err":>9}')
+    rows = []
+    for name in robot_names:
+        reference = None
+        for solver, step in [(solver, step)
+                             for solver in ('explicit', 'implicit')
+                             for step in sorted(dts)]:
+            case = dict(robot=name, n_boxes=n_boxes, solver=solver, dt=step)
+            result = run_isolated(
+                integration_case, case,
+                dict(settings, forward_only=True, dt=step,
+                     steps=round(simulated / step), spring_solver=solver,
+                     record_interval=round(sample_time / step)))
+            if 'error' in result:
+                print(f'{name:>8} {solver:>8} {step:>6} {result["error"]}')
+                rows.append(result)
+                continue
+            if reference is None:
+                # the explicit solver at the smallest dt is the reference
+                reference = dict(result)
+            positions = result.pop('positions')
+            frames = min(len(positions), len(reference['positions']))
+            error = np.linalg.norm(
+                positions[:frames] - reference['positions'][:frames], axis=-1)
+            result.update(
+                speedup=reference['wall_s'] / result['wall_s'],
+                rms_error=float(np.sqrt(np.mean(error**2))),
+                max_error=float(np.max(error)),
+                final_height_error=abs(result['final_height'] -
+                                       reference['final_height']))
+            rows.append(result)
+            note = '  diverged' if result['diverged'] else ''
+            print(f'{name:>8} {solver:>8} {step:>6} {result["steps"]:>5} '
+                  f'{result["wall_s"]:>7.3f} {result["speedup"]:>6.1f}x '
+                  f'{result["rms_error"]:>8.4f} {result["max_error"]:>8.4f} '
+                  f'{result["final_height_error"]:>9.4f}{note}')
+    return rows
+
+# for each benchmark metric, whether larger values are better
+benchmark_metrics = {'steps_per_s': True, 'launches_per_s': True,
+                     'compile_s': False, 'peak_rss_mb': False}
+benchmark_key = ('robot', 'n_boxes', 'toi', 'taped', 'fused', 'threads')
+
+
+def compare_benchmarks(report, baseline, tolerance=0.1):
+    """Returns the metrics that got worse than the baseline by more than
+    `tolerance` (relative), as (case, metric, baseline, current) tuples.
+    Cases missing from either report, or diverged in either, are skipped."""
+    for setting in ('arch', 'precision', 'steps'):
+        if report[setting] != baseline[setting]:
+            raise ValueError(f'the baseline was measured with {setting}='
+                             f'{baseline[setting]}, not {report[setting]}')
+
+    def key(case):
+        return tuple(case.get(name) for name in benchmark_key)
+
+    # diverged rollouts stop early, so their rates measure a different run
+    previous = {key(case): case for case in baseline['cases']
+                if 'error' not in case and not case.get('diverged')}
+    regressions = []
+    for case in report['cases']:
+        old = previous.get(key(case))
+        if old is None or 'error' in case or case['diverged']:
+            continue
+        for metric, higher_is_better in benchmark_metrics.items():
+            change = (case[metric] - old[metric]) / max(abs(old[metric]), 1e-9)
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append((key(case), metric, old[metric],
+                                    case[metric]))
+    return regressions
+
+
+import argparse
+
+# module settings taken from the command line; worker processes re-import
+# this module without running main() and receive them explicitly
+cli_settings = ('robot_id', 'n_boxes', 'use_fused', 'forward_only', 'steps',
+                'record_interval', 'checkpoint_interval', 'video_fps', 'arch',
+                'precision', 'headless', 'wheel_topology', 'wheel_neighbors',
+                'spring_budget', 'spring_gather', 'body_collision',
+                'watchdog_interval', 'max_speed', 'precompute_actuation',
+                'kernel_cache', 'dt', 'spring_solver')
+
+
+def configure(argv=None):
+    """Parses the command line into the module settings and starts Taichi."""
+    global robot_id, n_boxes, use_fused, forward_only, steps, \
+        record_interval, checkpoint_interval, video_fps, arch, precision, \
+        headless, cold_start, wheel_topology, wheel_neighbors, spring_budget, \
+        spring_gather, body_collision, watchdog_interval, max_speed, profiler, \
+        precompute_actuation, kernel_cache, dt, spring_solver
+
+    # Argument parser setup
+    parser = argparse.ArgumentParser()
+    parser.add_argument('robot_id', type=int, help='[robot_id=0, 1, 2, ...]')
+    parser.add_argument('cmd', type=str, help='train/plot/evolve/topology/collision/benchmark/controller/prewarm/integration')
+    parser.add_argument('--n_boxes', type=int, default=4, help='Number of boxes forming the wheel')
+    parser.add_argument('--fused', action='store_true', help='Run each rollout as one fused kernel instead of per-step launches')
+    parser.add_argument('--forward_only', action='store_true', help='Keep only the last two steps of state (no gradients, no max_steps cap)')
+    parser.add_argument('--steps', type=int, default=None, help=f'Number of simulated steps per rollout (default: {duration:g} s worth of --dt)')
+    parser.add_argument('--dt', type=float, default=dt, help='Simulated seconds per step')
+    parser.add_argument('--spring_solver', type=str, default=spring_solver, choices=['explicit', 'implicit'], help='Explicit spring forces, or a per-spring backward Euler solve that allows larger --dt')
+    parser.add_argument('--checkpoint_interval', type=int, default=0, help='Keep the state only every K steps when optimizing and recompute in between (0 disables)')
+    parser.add_argument('--generations', type=int, default=2, help='Generations for the evolve command')
+    parser.add_argument('--population', type=int, default=5, help='Population size for the evolve command')
+    parser.add_argument('--workers', type=int, default=0, help='Evaluate candidates in this many worker processes (0 = batched in-process)')
+    parser.add_argument('--timeout', type=float, default=None, help='Seconds before a worker candidate is killed')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for evolution and per-candidate seeding')
+    parser.add_argument('--fitness_cache', type=str, default=None, help='SQLite file caching fitness by genome hash across runs')
+    parser.add_argument('--snapshot', type=str, default=None, help='File the evolve command saves its population, best candidate and random state to after every generation')
+    parser.add_argument('--resume', action='store_true', help='Continue evolve from the --snapshot file instead of starting over')
+    parser.add_argument('--fitness_cache_size', type=int, default=10000, help='Maximum number of cached fitness values (LRU eviction)')
+    parser.add_argument('--record_interval', type=int, default=0, help='Copy the state into a recording buffer every N steps (0 disables)')
+    parser.add_argument('--trajectory', type=str, default=None, help='Directory the first rollout streams its recorded states into as .npy files (every --record_interval steps, default every step)')
+    parser.add_argument('--video', type=str, default=None, help='Stream the final rollout into this .gif/.mp4 file instead of PNG frames')
+    parser.add_argument('--video_fps', type=int, default=video_fps, help='Frame rate of --video')
+    parser.add_argument('--arch', type=str, default=arch, choices=['cpu', 'gpu', 'cuda', 'vulkan', 'metal'], help='Taichi backend')
+    parser.add_argument('--precision', type=str, default=precision, choices=['f32', 'f64'], help='Floating point precision of the simulation')
+    parser.add_argument('--headless', action='store_true', help='Never open a window; frames are still rendered offscreen when saved')
+    parser.add_argument('--topology', type=str, default=wheel_topology, choices=['full', 'ring', 'knn', 'random'], help='How the rim boxes of the wheel are connected')
+    parser.add_argument('--neighbors', type=int, default=wheel_neighbors, help='Springs per rim box for the knn and random topologies')
+    parser.add_argument('--spring_budget', type=int, default=spring_budget, help='Maximum number of springs per robot (0 = unlimited)')
+    parser.add_argument('--spring_gather', action='store_true', help='Sum spring impulses per object over its incident springs instead of atomic scatter')
+    parser.add_argument('--body_collision', type=str, default=body_collision, choices=['none', 'naive', 'grid'], help='Box-box contacts: off, all pairs, or spatial hash broad phase')
+    parser.add_argument('--precompute_actuation', action='store_true', help='Compute the open-loop actuation of all steps the state buffer holds in one launch instead of every step (not with --forward_only, whose buffer holds two)')
+    parser.add_argument('--kernel_cache', type=str, default=None, help="Directory of the compiled kernel cache shared by all runs and workers (default: Taichi's)")
+    parser.add_argument('--profile', action='store_true', help='Time every phase of the rollouts (wall and kernel time) and print a summary at exit')
+    parser.add_argument('--profile_output', type=str, default=None, help='Also write the --profile summary to this JSON file')
+    parser.add_argument('--watchdog_interval', type=int, default=watchdog_interval, help='Check for diverged robots every N steps and stop once all have diverged (0 disables)')
+    parser.add_argument('--max_speed', type=float, default=max_speed, help='Box speed above which the watchdog treats a robot as diverged')
+    parser.add_argument('--bench_boxes', type=str, default=None, help='Comma separated box counts for the topology (default 10,50,100,200), collision (10,100,1000), benchmark (5,20,50 wheels) and controller (5,20,100) and prewarm (5,10) commands')
+    parser.add_argument('--bench_dts', type=str, default='0.001,0.002,0.004,0.008', help='Comma separated timesteps for the integration command; each must divide 0.016 s')
+    parser.add_argument('--bench_robots', type=str, default='robotA,robotB,robotLeg,wheel', help='Comma separated robots for the benchmark command (robot_config builders or wheel)')
+    parser.add_argument('--bench_threads', type=str, default=','.join(map(str, sorted({1, multiprocessing.cpu_count()}))), help='Comma separated CPU thread counts for the benchmark command')
+    parser.add_argument('--bench_output', type=str, default='benchmark.json', help='JSON file the benchmark command writes its report to')
+    parser.add_argument('--bench_baseline', type=str, default=None, help='Earlier benchmark report to compare against; regressions make the command fail')
+    parser.add_argument('--bench_tolerance', type=float, default=0.1, help='Relative change of a benchmark metric that counts as a regression')
+    options = parser.parse_args(argv)
+    if options.resume and not options.snapshot:
+        parser.error('--resume needs --snapshot')
+
+    robot_id = options.robot_id
+    n_boxes = options.n_boxes
+    use_fused = options.fused
+    forward_only = options.forward_only
+    dt = options.dt
+    steps = options.steps or round(duration / dt)
+    spring_solver = options.spring_solver
+    record_interval = options.record_interval
+    if options.trajectory and not record_interval:
+        record_interval = 1
+    checkpoint_interval = options.checkpoint_interval
+    video_fps = options.video_fps
+    arch = options.arch
+    precision = options.precision
+    headless = options.headless
+    wheel_topology = options.topology
+    wheel_neighbors = options.neighbors
+    spring_budget = options.spring_budget
+    spring_gather = options.spring_gather
+    body_collision = options.body_collision
+    watchdog_interval = options.watchdog_interval
+    max_speed = options.max_speed
+    precompute_actuation = options.precompute_actuation
+    kernel_cache = options.kernel_cache
+
+    cold_start = {'import': time.perf_counter()}
+    # the controller benchmark times compilation, which the cache would skip
+    init_taichi(kernel_profiler=options.profile,
+                offline_cache=options.cmd != 'controller')
+    cold_start['ti.init'] = time.perf_counter()
+    if options.profile:
+        profiler = PhaseProfiler(kernel_time=True)
+    return options
+
+
+def main(argv=None):
+    options = configure(argv)
+    try:
+        run_command(options)
+    finally:
+        if profiler is not None:
+            profiler.print_summary()
+            if options.profile_output:
+                profiler.export(options.profile_output)
+
+
+def run_command(options):
+    print(robot_id, options.cmd)
+
+    if options.cmd == 'evolve':
+        evolutionary_optimization(generations=options.generations,
+                                  population_size=options.population,
+                                  workers=options.workers,
+                                  timeout=options.timeout,
+                                  seed=options.seed,
+                                  cache_path=options.fitness_cache,
+                                  cache_size=options.fitness_cache_size,
+                                  snapshot_path=options.snapshot,
+                                  resume=options.resume)
+        return
+
+    def box_counts(default):
+        return [int(count) for count in (options.bench_boxes or default).split(',')]
+
+    if options.cmd == 'collision':
+        benchmark_collisions(box_counts('10,100,1000'))
+        return
+
+    if options.cmd == 'topology':
+        benchmark_topologies(box_counts('10,50,100,200'))
+        return
+
+    if options.cmd == 'prewarm':
+        prewarm_kernels(box_counts('5,10'), sorted({1, options.population}))
+        return
+
+    if options.cmd == 'integration':
+        integration_report([builder.__name__ for builder in robot_config.robots],
+                           [float(step) for step in options.bench_dts.split(',')])
+        return
+
+    if options.cmd == 'controller':
+        benchmark_controllers(box_counts('5,20,100'))
+        return
+
+    if options.cmd == 'benchmark':
+        report = run_benchmarks(options.bench_robots.split(','),
+                                box_counts('5,20,50'),
+                                [int(n) for n in options.bench_threads.split(',')],
+                                fused=use_fused)
+        with open(options.bench_output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f'Report written to {options.bench_output}')
+        if options.bench_baseline:
+            with open(options.bench_baseline) as f:
+                baseline = json.load(f)
+            regressions = compare_benchmarks(report, baseline,
+                                             options.bench_tolerance)
+            for case, metric, old, new in regressions:
+                print(f'REGRESSION {case}: {metric} {old:.4g} -> {new:.4g}')
+            if regressions:
+                sys.exit(1)
+            print('No regressions against', options.bench_baseline)
+        return
 
-if __name__ == '__main__':
     best_n_boxes = n_boxes if n_boxes else 6  # Use provided n_boxes or default to 6
-    setup_robot(*robots[robot_id](best_n_boxes))
+    with profile_phase('setup'):
+        setup_robot(*robots[robot_id](best_n_boxes))
     
     # Initialize the neural network weights to prevent errors
-    for i in range(n_hidden):
-        for j in range(n_input_states()):
-            weights1[i, j] = np.random.normal(0, 0.1)
-        bias1[i] = 0
-    
-    for i in range(n_springs):
-        for j in range(n_hidden):
-            weights2[i, j] = np.random.normal(0, 0.1)
-        bias2[i] = 0
+    load_weights(np.random.normal(0, 0.1, weights1.shape),
+                 w2=np.random.normal(0, 0.1, weights2.shape))
+    cold_start['setup'] = time.perf_counter()
     
     # Run the simulation with visualizations
-    forward(visualize=True)
+    forward(visualize=True, trajectory=options.trajectory)
     
     # Save a video of the final result
-    forward('open_loop_control')
-    
-    print("Open-loop experiment completed. Results saved to 'rigid_body/open_loop_control/'")
+    if options.video:
+        forward(options.video)
+        print(f"Open-loop experiment completed. Video saved to '{options.video}'")
+    else:
+        forward('open_loop_control')
+        print("Open-loop experiment completed. Results saved to 'rigid_body/open_loop_control/'")
 
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import math
+import sqlite3
+
+import numpy as np
+
+
+def genome_hash(objects, springs, **settings):
+    """Canonical hash of a robot and the settings its fitness depends on.
+
+    Numbers are normalized to plain floats so tuples, lists and numpy
+    arrays describing the same robot hash the same.
+    """
+    def canonical(value):
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return [canonical(v) for v in value]
+        if isinstance(value, (int, float, np.integer, np.floating)):
+            return float(value)
+        return value
+
+    payload = json.dumps(
+        {
+            'objects': canonical(objects),
+            'springs': canonical(springs),
+            'settings': {k: canonical(v) for k, v in sorted(settings.items())},
+        },
+        sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class FitnessCache:
+    """Fitness values keyed by genome hash, stored in an SQLite file.
+
+    Holds at most `capacity` entries and evicts the least recently used
+    ones. NaN fitness (diverged candidates) is cached as well.
+    """
+
+    def __init__(self, path, capacity=10000):
+        self.capacity = capacity
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS fitness '
+                        '(key TEXT PRIMARY KEY, value REAL, last_used INTEGER)')
+        self.clock = self.db.execute(
+            'SELECT COALESCE(MAX(last_used), 0) FROM fitness').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def _tick(self):
+        self.clock += 1
+        return self.clock
+
+    def get(self, key):
+        """Returns the cached fitness, or None on a miss."""
+        row = self.db.execute('SELECT value FROM fitness WHERE key = ?',
+                              (key, )).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute('UPDATE fitness SET last_used = ? WHERE key = ?',
+                        (self._tick(), key))
+        self.db.commit()
+        return math.nan if row[0] is None else row[0]
+
+    def put(self, key, value):
+        value = float(value)
+        self.db.execute(
+            'INSERT OR REPLACE INTO fitness VALUES (?, ?, ?)',
+            (key, None if math.isnan(value) else value, self._tick()))
+        self.db.execute(
+            'DELETE FROM fitness WHERE key NOT IN '
+            '(SELECT key FROM fitness ORDER BY last_used DESC LIMIT ?)',
+            (self.capacity, ))
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM fitness').fetchone()[0]
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.db.close()
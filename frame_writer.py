@@ -0,0 +1,104 @@
+import os
+import queue
+import shutil
+import subprocess
+import threading
+
+import numpy as np
+
+
+class FrameWriter:
+    """Encodes frames into a single GIF or video file on a background thread.
+
+    `write()` only blocks once `max_queue` frames are waiting, i.e. when the
+    encoder has fallen behind. GIFs are encoded with Pillow; other formats
+    (e.g. .mp4) are piped into ffmpeg, which must be on the PATH.
+    """
+
+    def __init__(self, path, fps=30, max_queue=16):
+        self.path = path
+        self.fps = fps
+        self.gif = os.path.splitext(path)[1].lower() == '.gif'
+        if not self.gif and shutil.which('ffmpeg') is None:
+            raise RuntimeError(f'ffmpeg is required to write {path}')
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.frames = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.finished = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, image):
+        """Queues a frame as returned by ti.GUI.get_image()."""
+        if self.error is not None:
+            raise self.error
+        # the GUI reuses its image buffer for every frame
+        self.frames.put(np.array(image, copy=True))
+
+    def close(self):
+        """Waits for the queued frames and finishes the file."""
+        self.frames.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        try:
+            if self.gif:
+                self._encode_gif()
+            else:
+                self._encode_ffmpeg()
+        except Exception as e:
+            self.error = e
+            # keep draining so write() never blocks on a dead encoder
+            while not self.finished and self.frames.get() is not None:
+                pass
+
+    def _next_frame(self):
+        image = self.frames.get()
+        if image is None:
+            self.finished = True
+            return None
+        # ti.GUI images are indexed [x, y] with y pointing up
+        rgb = np.flipud(image[:, :, :3].transpose(1, 0, 2))
+        return np.ascontiguousarray(np.clip(rgb * 255, 0, 255).astype(np.uint8))
+
+    def _encode_gif(self):
+        from PIL import Image
+
+        def quantized():
+            while (rgb := self._next_frame()) is not None:
+                yield Image.fromarray(rgb).quantize(
+                    colors=256, method=Image.Quantize.FASTOCTREE)
+
+        # Pillow pulls the remaining frames from the generator while it
+        # encodes, so frames are processed as they arrive
+        frames = quantized()
+        first = next(frames, None)
+        if first is not None:
+            first.save(self.path,
+                       save_all=True,
+                       append_images=frames,
+                       duration=round(1000 / self.fps),
+                       loop=0)
+
+    def _encode_ffmpeg(self):
+        process = None
+        try:
+            while (rgb := self._next_frame()) is not None:
+                if process is None:
+                    height, width = rgb.shape[:2]
+                    process = subprocess.Popen(
+                        ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo',
+                         '-pix_fmt', 'rgb24', '-s', f'{width}x{height}',
+                         '-r', str(self.fps), '-i', '-', '-pix_fmt', 'yuv420p',
+                         self.path],
+                        stdin=subprocess.PIPE)
+                process.stdin.write(rgb.tobytes())
+        finally:
+            if process is not None:
+                process.stdin.close()
+                if process.wait() != 0:
+                    raise RuntimeError(f'ffmpeg failed writing {self.path}')
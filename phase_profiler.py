@@ -0,0 +1,78 @@
+import contextlib
+import json
+import time
+
+import taichi as ti
+
+
+class PhaseProfiler:
+    """Accumulates wall time and kernel time per named phase.
+
+    Phases nest: a phase's time excludes the phases opened inside it, so
+    the totals add up to the profiled wall time. Each phase boundary waits
+    for the device (`ti.sync()`), so asynchronous backends are timed too.
+    Kernel time is only available when Taichi was started with
+    `kernel_profiler=True`; it is collected by draining Taichi's profiler
+    at every boundary.
+    """
+
+    def __init__(self, kernel_time=False):
+        self.kernel_time = kernel_time
+        self.wall = {}
+        self.kernel = {}
+        self.calls = {}
+        # [name, children's wall time] of the open phases
+        self.stack = []
+        if kernel_time:
+            ti.profiler.clear_kernel_profiler_info()
+
+    def _drain_kernel_time(self):
+        if not self.kernel_time:
+            return
+        elapsed = ti.profiler.get_kernel_profiler_total_time()
+        ti.profiler.clear_kernel_profiler_info()
+        if self.stack:
+            name = self.stack[-1][0]
+            self.kernel[name] = self.kernel.get(name, 0.0) + elapsed
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        ti.sync()
+        self._drain_kernel_time()
+        self.stack.append([name, 0.0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            ti.sync()
+            elapsed = time.perf_counter() - start
+            self._drain_kernel_time()
+            _, children = self.stack.pop()
+            self.wall[name] = self.wall.get(name, 0.0) + elapsed - children
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if self.stack:
+                self.stack[-1][1] += elapsed
+
+    def summary(self):
+        """Per phase totals, slowest first."""
+        total = sum(self.wall.values()) or 1.0
+        return [{'phase': name,
+                  'calls': self.calls[name],
+                  'wall_s': wall,
+                  'wall_share': wall / total,
+                  'kernel_s': self.kernel.get(name, 0.0) if self.kernel_time else None}
+                for name, wall in sorted(self.wall.items(), key=lambda item: -item[1])]
+
+    def print_summary(self):
+        print(f'{"phase":>14} {"calls":>8} {"wall s":>9} {"share":>6} '
+              f'{"kernel s":>9} {"ms/call":>8}')
+        for row in self.summary():
+            kernel = ('{:>9.3f}'.format(row['kernel_s'])
+                      if row['kernel_s'] is not None else '{:>9}'.format('-'))
+            print(f'{row["phase"]:>14} {row["calls"]:>8} {row["wall_s"]:>9.3f} '
+                  f'{row["wall_share"]:>6.1%} {kernel} '
+                  f'{row["wall_s"] / row["calls"] * 1e3:>8.3f}')
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
@@ -1,5 +1,11 @@
+import functools
 import math
+from typing import NamedTuple
 
+import numpy as np
+from numpy.lib import recfunctions
+
+# the lists add_object/add_spring append to; every builder gets fresh ones
 objects = []
 springs = []
 
@@ -14,6 +20,23 @@ def add_spring(a, b, offset_a, offset_b, length, stiffness, actuation=0.0):
     springs.append([a, b, offset_a, offset_b, length, stiffness, actuation])
 
 
+def builder(function):
+    """Makes a builder append to fresh lists, so each call returns a robot
+    of its own instead of extending the previous one."""
+    @functools.wraps(function)
+    def build(*args, **kwargs):
+        global objects, springs
+        saved = objects, springs
+        objects, springs = [], []
+        try:
+            return function(*args, **kwargs)
+        finally:
+            objects, springs = saved
+
+    return build
+
+
+@builder
 def robotA():
     add_object(x=[0.3, 0.25], halfsize=[0.15, 0.03])
     add_object(x=[0.2, 0.15], halfsize=[0.03, 0.02])
@@ -35,6 +58,7 @@ def robotA():
     return objects, springs, 0
 
 
+@builder
 def robotC():
     add_object(x=[0.3, 0.25], halfsize=[0.15, 0.03])
     add_object(x=[0.2, 0.15], halfsize=[0.03, 0.02])
@@ -77,6 +101,7 @@ def rotAlong(half_length, deg, center):
 half_hip_length = 0.08
 
 
+@builder
 def robotLeg():
     #hip
     add_object(hip_pos, halfsize=[0.06, half_hip_length])
@@ -154,6 +179,7 @@ def robotLeg():
     return objects, springs, 3
 
 
+@builder
 def robotB():
     body = add_object([0.15, 0.25], [0.1, 0.03])
     back = add_object([0.08, 0.22], [0.03, 0.10])
@@ -179,4 +205,88 @@ def robotB():
     return objects, springs, body
 
 
+
+# one row per body / spring; their fields flatten, in order, to the float
+# table columns the simulator loads
+object_dtype = np.dtype([('x', np.float64, 2), ('halfsize', np.float64, 2),
+                         ('rotation', np.float64)])
+spring_dtype = np.dtype([('a', np.int32), ('b', np.int32),
+                         ('offset_a', np.float64, 2),
+                         ('offset_b', np.float64, 2), ('length', np.float64),
+                         ('stiffness', np.float64), ('actuation', np.float64)])
+
+
+class Genome(NamedTuple):
+    """A robot as fixed arrays: `objects` of object_dtype, `springs` of
+    spring_dtype and the head object's index.
+
+    Unpacks like a builder's (objects, springs, head_id) result. mutate and
+    crossover keep the topology (which bodies each spring joins, and which
+    springs are joints) and write into `out` when given, so a population
+    can be bred into preallocated genomes.
+    """
+    objects: np.ndarray
+    springs: np.ndarray
+    head_id: int
+
+    @classmethod
+    def from_lists(cls, objects, springs, head_id):
+        bodies = np.zeros(len(objects), object_dtype)
+        for i, (x, halfsize, rotation) in enumerate(objects):
+            bodies[i] = (x, halfsize, rotation)
+        links = np.zeros(len(springs), spring_dtype)
+        for i, spring in enumerate(springs):
+            links[i] = tuple(spring)
+        return cls(bodies, links, int(head_id))
+
+    def copy(self):
+        return Genome(self.objects.copy(), self.springs.copy(), self.head_id)
+
+    def tables(self):
+        """The (n_objects, 5) and (n_springs, 9) float tables."""
+        return (recfunctions.structured_to_unstructured(self.objects, np.float64),
+                recfunctions.structured_to_unstructured(self.springs, np.float64))
+
+    def mutate(self, rng, scale=0.1, out=None):
+        """Scales spring stiffness, rest lengths and actuation by random
+        factors around 1 with spread `scale`. Joints keep their -1 length."""
+        if out is None:
+            out = self.copy()
+        elif out is not self:
+            _same_shape(out, self)
+            out.objects[...] = self.objects
+            out.springs[...] = self.springs
+        n = len(self.springs)
+        # taken before scaling, which changes self as well when out is self
+        joints = self.springs['length'] == -1
+        for name in ('stiffness', 'length', 'actuation'):
+            out.springs[name] *= np.exp(scale * rng.standard_normal(n))
+        out.springs['length'][joints] = -1
+        return out
+
+    def crossover(self, other, rng, out=None):
+        """Takes every body and spring from either parent at random."""
+        _same_shape(other, self)
+        if not np.array_equal(self.springs[['a', 'b']], other.springs[['a', 'b']]):
+            raise ValueError('crossover needs parents with the same topology')
+        out = self.copy() if out is None else _same_shape(out, self)
+        for table, mine, theirs in ((out.objects, self.objects, other.objects),
+                                    (out.springs, self.springs, other.springs)):
+            np.copyto(table, np.where(rng.random(len(table)) < 0.5, mine, theirs))
+        return out
+
+
+def _same_shape(genome, like):
+    if len(genome.objects) != len(like.objects) or \
+            len(genome.springs) != len(like.springs):
+        raise ValueError('genomes differ in their number of bodies or springs')
+    return genome
+
+
+def to_genome(build, *args, **kwargs):
+    """Runs a list based builder (robotA, robotB, robotC, robotLeg, or
+    wheel_pattern_robot of the simulator) and returns its Genome."""
+    return Genome.from_lists(*build(*args, **kwargs))
+
+
 robots = [robotA, robotB, robotLeg]
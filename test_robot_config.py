@@ -0,0 +1,24 @@
+import numpy as np
+
+import robot_config
+
+
+def joint_count(genome):
+    return int(np.count_nonzero(genome.springs['length'] == -1))
+
+
+def test_mutate_in_place_keeps_joints():
+    genome = robot_config.to_genome(robot_config.robotLeg)
+    joints = joint_count(genome)
+    assert joints > 0
+    rng = np.random.default_rng(0)
+    for _ in range(10):
+        genome.mutate(rng, out=genome)
+    assert joint_count(genome) == joints
+
+
+def test_mutate_into_other_genome_keeps_joints():
+    genome = robot_config.to_genome(robot_config.robotLeg)
+    out = genome.copy()
+    genome.mutate(np.random.default_rng(0), out=out)
+    assert joint_count(out) == joint_count(genome)
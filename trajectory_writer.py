@@ -0,0 +1,59 @@
+import json
+import os
+
+import numpy as np
+
+
+class TrajectoryWriter:
+    """Streams recorded rollout frames into memory-mapped .npy files.
+
+    Every array in `shapes` becomes `<directory>/<name>.npy` of shape
+    (frames, *shape), allocated up front and filled chunk by chunk by
+    `write()`, so only the pages being written are held in memory. `close()`
+    flushes the files and writes `metadata.json` next to them, including
+    how many frames were written; a rollout that stopped early leaves the
+    remaining frames zero.
+    """
+
+    def __init__(self, directory, frames, shapes, dtype, metadata):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.metadata = dict(metadata)
+        self.arrays = {
+            name: np.lib.format.open_memmap(os.path.join(directory, name + '.npy'),
+                                            mode='w+', dtype=dtype,
+                                            shape=(frames, *shape))
+            for name, shape in shapes.items()
+        }
+        self.frames = 0
+
+    def write(self, start, chunks):
+        """Stores frames start.. of every array from `chunks`, name -> array."""
+        for name, chunk in chunks.items():
+            self.arrays[name][start:start + len(chunk)] = chunk
+        self.frames = max(self.frames, start + len(next(iter(chunks.values()))))
+
+    def close(self):
+        for array in self.arrays.values():
+            array.flush()
+        self.metadata.update(
+            frames=self.frames,
+            arrays={name: {'file': name + '.npy', 'shape': list(array.shape),
+                           'dtype': array.dtype.name}
+                    for name, array in self.arrays.items()})
+        with open(os.path.join(self.directory, 'metadata.json'), 'w') as f:
+            json.dump(self.metadata, f, indent=1)
+        self.arrays = {}
+
+
+def read_trajectory(directory):
+    """Returns the metadata and the arrays of an exported trajectory, the
+    arrays memory-mapped read-only and cut to the frames written."""
+    with open(os.path.join(directory, 'metadata.json')) as f:
+        metadata = json.load(f)
+    arrays = {
+        name: np.load(os.path.join(directory, entry['file']),
+                      mmap_mode='r')[:metadata['frames']]
+        for name, entry in metadata['arrays'].items()
+    }
+    return metadata, arrays